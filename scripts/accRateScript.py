@@ -33,12 +33,17 @@ from functools import partial
 
 # Custom Helper Modules
 import worker
+import accRate
+import geometry
 import plot
-import timer
+import resources
+import results
+import instrument
+import shared
+import snapshots
 
 # Other Python modules
 import numpy as np
-import re
 
 # ==== ==== Validation Helper Functions ==== ==== #
 
@@ -68,15 +73,6 @@ def radial_int(value):
         raise ValueError(f"{fvalue} is out of bounds. Radius must be between -{len_r} and {len_r -1}.") 
     return fvalue
 
-
-def sort_files(file_list):
-    def extract_num(file):
-        match = re.search(r'\.(\d+)\.athdf$', file)
-        return int(match.group(1)) if match else -1
-
-    file_list.sort(key=lambda f: extract_num(os.path.basename(f)))   # returns None
-    return file_list
-
 """
 This function recursively walks upward from the file location to find the project root. 
 marker_name can be a directory like ".git" or a file (".yml")
@@ -101,38 +97,60 @@ def find_proj_root(marker_name):
 
 
 # ==== ==== Core Worker ===== ===== #
-def run_worker_script(file_path, radius):
+"""
+Runs accRate.run_program directly inside a pool process. The pool processes are 
+long-lived, so the interpreter start-up and module imports are paid once per 
+process instead of once per file. The result is written into slot `index` of 
+the controller's shared buffer.
+Argument(s): index (int), file_path (str), radius (int), shm_name (str)
+Optional: profile_dir=None (dump a cProfile of the file there), 
+  float32=False (weight the shells in float32, see accRate.mass_flux)
+Returns: (True if the result was written, False if the file could not be processed, 
+  list of the timing records of the file)
+"""
+def run_worker(index, file_path, radius, shm_name, profile_dir=None, float32=False):
+    # Use absolute paths so worker processes can find external hard drives
+    file_path = os.path.abspath(file_path) # path of athdf file
+
+    ok = True
+    with instrument.profiled(profile_dir, os.path.basename(file_path)), instrument.task(file_path):
+        try: 
+            result = accRate.run_program(file_path, radius, float32=float32)
+            with instrument.span("ipc"):
+                shared.write_result(shm_name, index, result)
+        except Exception as e: 
+            print(f"Error: accRate.run_program failed on {file_path}: {e}")
+            ok = False
+    return ok, instrument.drain()
+
+
+"""
+Runs accRate.py as a separate Python process for one file, for debugging or when 
+each file must be isolated from the others. The worker writes its result into 
+slot `index` of the controller's shared buffer. Only the whole run of the 
+process is timed, and profile_dir is not used.
+Returns: (bool, list of the timing records of the file), as run_worker
+"""
+def run_worker_script(index, file_path, radius, shm_name, profile_dir=None, float32=False):
     # Use absolute paths so worker processes can find external hard drives
     file_path = os.path.abspath(file_path) # path of athdf file
-    
-    # Create output filename based on input filename
-    output_file = file_path + ".npy"
 
     project_root = find_proj_root('.git')
     # Debugging: print(f"Root: {project_root}")
     worker_path = os.path.join(project_root, 'scripts', 'accRate.py')
 
-    result = subprocess.run(
-        [sys.executable, worker_path, str(radius), file_path, output_file],
-        capture_output=True, text=True
-    )
+    command = [sys.executable, worker_path, str(radius), file_path, "--shm", shm_name, str(index)]
+    if float32:
+        command.append("--float32")
+    with instrument.task(file_path):
+        result = subprocess.run(command, capture_output=True, text=True)
     
-    # Check if worker.py succeeded
+    # Check if accRate.py succeeded
     if result.returncode != 0: 
-        print(f"Error: worker.py failed on {file_path}:\n{result.stderr}") 
-        return None
-
-    # Load the .npy result
-    try: 
-        arr = np.load(output_file)
-    except Exception as e: 
-        print(f"Error: failed to load {output_file}: {e}")
-        return None   
-
-    # Delete the .npy file when no longer needed 
-    os.remove(output_file)
+        print(f"Error: accRate.py failed on {file_path}:\n{result.stderr}") 
+        return False, instrument.drain()
 
-    return arr 
+    return True, instrument.drain()
 
 
 # ==== ==== THE MAIN FUNCTION ==== ==== #
@@ -145,101 +163,155 @@ def main():
     parser.add_argument("-t", "--time", 
     action="store_true",
     dest="time_measured",
-    help="Option to measure and display time of program.")
+    help="Show the time spent per stage (read, accretion rate, ...) over all workers. "
+         "The plot stage includes the time the plot window is open.")
+
+    parser.add_argument("--report", 
+    metavar="PATH",
+    help="Save the per-stage timings and the raw timing records to PATH (.json).")
+
+    parser.add_argument("--profile", 
+    metavar="DIR",
+    help="Dump cProfile statistics of the controller and of every file processed in the pool to DIR.")
     
     parser.add_argument("-d", "--dir", default=".", help='Path to the drectory contianing the .athdf files (default: current directory)')    
 
+    snapshots.add_arguments(parser)
+
+    parser.add_argument("--subprocess", 
+    action="store_true",
+    dest="use_subprocess",
+    help="Run accRate.py as a new Python process for every file instead of inside the worker pool.")
+
+    parser.add_argument("--workers", 
+    type=snapshots.positive_int, metavar="N",
+    help="Number of worker processes (default: as many as the cores and --max-mem allow).")
+
+    parser.add_argument("--max-mem", 
+    type=resources.memory_spec, metavar="SIZE",
+    help="Memory all workers together may use, e.g. 200G, used to size the pool "
+         "(default: 80%% of the available memory).")
+
+    parser.add_argument("--float32", 
+    action="store_true",
+    help="Weight the shells in float32, the precision of the files, and only sum in float64. "
+         "See accRate.mass_flux for the error bound.")
+
+    parser.add_argument("--no-cache", 
+    action="store_true",
+    dest="no_cache",
+    help="Recompute every file instead of reusing results cached by earlier runs.")
+
+    parser.add_argument("--cache-size", 
+    type=resources.memory_spec, default=results.MAX_BYTES, metavar="SIZE",
+    dest="cache_size",
+    help="Size limit of the result cache, e.g. 500M or 10G; the least recently used "
+         "results are removed first (default: 2G).")
+
     args = parser.parse_args()
+
+    # Timing records of the controller and the workers
+    instrument.enable()
+    report = instrument.Report()
+    profiler = instrument.start_profile() if args.profile else None
     
     # Can manually specify files here
     # file_list = ["disk.out1.00018.athdf", "disk.out1.00019.athdf"]
-    
-    """
-    # TODO: add --start, -s and --end, -e and --inc, -i flags
-    os.path.exists(filename)
-
-    specify range for customization
-    - assumes filenames follow strict pattern
-    - selective filtering of athdf files
-    """
 
     # ---- ---- Find the files to process ---- ---- #
-    data_dir = os.path.abspath(args.dir) # Normalizing the path
-    file_list = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith(".athdf")]
+    # Snapshot order, narrowed down by -s/-e/-i and --t-min/--t-max. The 
+    # index keeps the headers of earlier runs, so only new files are opened.
+    with instrument.span("scan"):
+        index = snapshots.scan(args.dir)
+        file_list = snapshots.select_from_args(list(index), args, index)
+        file_list = snapshots.validate(file_list, index, quantities=accRate.QUANTITIES)
 
     if not file_list: # file list is empty
-        print(f"There are no .athdf files detected in directory: {args.dir}")
+        print(f"There are no selected .athdf files in directory: {args.dir}")
         return # Should stop the program, since nohing to compute
 
-    file_list = sort_files(file_list)
-
     # Debugging which files used.
     print(f"Files used: {file_list}") 
     first_f = file_list[0] # fastest
     print(first_f)
 
-    if args.time_measured:
-        t = timer.Timer()
-        t.start_time()
-
-    worker_fn = partial(run_worker_script, radius=args.radius)
-
-    # If doesn't exist, save theta and phi arrays for later
-    theta_path = os.path.abspath("theta.npy")
-    phi_path = os.path.abspath("phi.npy")
-    
-    if (not os.path.exists(theta_path)):
-        plot.save_theta(first_f)
-    if (not os.path.exists(phi_path)):
-        plot.save_phi(first_f)
-
-    # Create output filename based on input filename
-    output_file = file_list[0][0:-7] + ".npy"
-
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(worker_fn, file_list))
-    
-    """ Change this debug to work on 1d results array    
-    # TODO: don't keep this debug, but write a check to ensure correct type
-    # Debugging: 
-    for i, r in enumerate(results):
-        if r is None:
-            print(f"[DEBUG] results[{i}] is None")
-        elif not isinstance(r, np.ndarray):
-            print(f"[DEBUG] results[{i}] is NOT a NumPy array: {type(r)}")
-        elif r.shape != (256, 256):
-            print(f"[DEBUG] results[{i}] has shape {r.shape}")
-        elif r.dtype == object:
-            print(f"[DEBUG] results[{i}] has dtype=object")
-    """
-    
-    
-    loading = "./theta.npy"
-    try: 
-        theta = np.load(loading)
-        loading = "./phi.npy"
-        phi = np.load(loading)
-    except Exception as e: 
-        print(f"Error: failed to load {loading}: {e}")
-        return None 
+    if args.use_subprocess:
+        worker_fn = run_worker_script
+    else:
+        worker_fn = run_worker
+
+    # Results of earlier runs come straight from the cache, only new or 
+    # changed files go to the workers
+    rates = [np.nan] * len(file_list)
+    todo = list(range(len(file_list)))
+    if not args.no_cache:
+        cache = results.ResultCache("accretion_rate-float32" if args.float32 else "accretion_rate", results.code_version(accRate, accRate.athena_read, geometry))
+        keys = [cache.keys(f, args.radius) for f in file_list]
+        todo = []
+        for i in range(len(file_list)):
+            with instrument.span("cache"):
+                arr = cache.load(keys[i])
+            if arr is None:
+                todo.append(i)
+            else:
+                rates[i] = float(arr[0])
+        print(f"{len(file_list) - len(todo)} of {len(file_list)} files taken from the result cache")
+
+    # Shared buffer with one slot per file, filled in by the workers. 
+    # Files that fail keep NaN and show up as gaps in the plot.
+    if todo:
+        # As many workers as the cores and the memory allow, from the grid of the first 
+        # file. Loading it builds the geometry cache once for the workers.
+        geom = geometry.load(first_f)
+        task_bytes = accRate.task_bytes(geometry.grid_shape(geom), args.radius)
+        if args.use_subprocess: # every file runs in a new interpreter besides the pool process
+            task_bytes += resources.PROCESS_BYTES
+        n_workers = resources.pool_size(task_bytes, len(todo), workers=args.workers, max_mem=args.max_mem)
+
+        shm, buffer = shared.create_buffer((len(todo),))
+        try: 
+            buffer.fill(np.nan)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                outcomes = list(executor.map(partial(worker_fn, radius=args.radius, shm_name=shm.name, 
+                                                     profile_dir=args.profile, float32=args.float32),
+                                             range(len(todo)), [file_list[i] for i in todo]))
+
+            for slot, i in enumerate(todo):
+                ok, records = outcomes[slot]
+                report.add(records)
+                if not ok:
+                    print(f"[DEBUG] {file_list[i]} failed")
+                    continue
+                rates[i] = float(buffer[slot])
+                if not args.no_cache:
+                    cache.save(keys[i], [rates[i]])
+        finally: 
+            del buffer # release the view so the block can be closed
+            shared.release(shm)
+
+    if not args.no_cache:
+        results.prune(max_bytes=args.cache_size)
     
     
     # Scale the yaxis data
-    yArr = results
+    yArr = rates
     print(yArr)  
   
     # Define x array
-    xArr = list(range(len(results)))
+    xArr = list(range(len(rates)))
 
 
-    if args.time_measured:
-        t.end_time()
-
-    plot.plot_data(xArr, yArr, rad=args.radius, xlabel=f"Time: 0 to {len(results)-1} seconds", ylabel="Accretion rate at r", title="Accretion Rate as a function of time")	
+    with instrument.span("plot"):
+        plot.plot_data(xArr, yArr, rad=args.radius, xlabel=f"Time: 0 to {len(rates)-1} seconds", ylabel="Accretion rate at r", title="Accretion Rate as a function of time")	
 
     print("Program executed successfully!")
+    if profiler is not None:
+        instrument.stop_profile(profiler, os.path.join(args.profile, "controller.prof"))
+    report.add(instrument.drain())
     if args.time_measured:
-        t.getTotalTime()
+        report.show()
+    if args.report:
+        report.save(args.report)
 
 	
 if __name__ == "__main__":
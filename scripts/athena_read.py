@@ -3,6 +3,7 @@ Read Athena++ output data files.
 """
 
 # Python modules
+import contextlib
 import re
 import struct
 import sys
@@ -15,8 +16,23 @@ import os
 # Other Python modules
 import numpy as np
 
+# Optional per-stage timing of the analysis scripts, reading works the same without it
+try:
+    import instrument as _instrument
+except ImportError:
+    _instrument = None
+
 check_nan_flag = False
 
+# Largest amount of cell data (in bytes) read from one dataset in a single hyperslab
+# when reading runs of consecutive MeshBlocks
+block_run_bytes = 64 * 2**20
+
+# Coordinate arrays computed by athdf, keyed by grid, so that repeated reads of
+# snapshots on the same grid skip recomputing them
+coordinate_cache_size = 16
+_coordinate_cache = {}
+
 # ========================================================================================
 
 def check_nan(data):
@@ -26,6 +42,15 @@ def check_nan(data):
     return
 
 
+# ========================================================================================
+
+def _stage(name):
+    """Time a stage of athdf() when the instrument module is available."""
+    if _instrument is None:
+        return contextlib.nullcontext({})
+    return _instrument.span(name)
+
+
 # ========================================================================================
 
 def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=None,
@@ -38,6 +63,8 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
 
     Keyword arguments:
     raw -- if True, do not merge MeshBlocks into a single array (default False)
+    quantities -- names of the variables to read; only their datasets are touched
+                  (default None, read all variables)
     """
 
     # Load HDF5 reader
@@ -73,12 +100,14 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
             variable_names = np.array([x.decode('ascii', 'replace')
                                        for x in f.attrs['VariableNames'][:]])
 
-            # Store cell data
+            # Store cell data, only reading the requested quantities if given
             for dataset_index, dataset_name in enumerate(dataset_names):
                 variable_begin = sum(dataset_sizes[:dataset_index])
                 variable_end = variable_begin + dataset_sizes[dataset_index]
                 variable_names_local = variable_names[variable_begin:variable_end]
                 for variable_index, variable_name in enumerate(variable_names_local):
+                    if quantities is not None and variable_name not in quantities:
+                        continue
                     data[variable_name] = f[dataset_name][variable_index, ...]
 
         if check_nan_flag:
@@ -96,7 +125,9 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
         new_data = False
 
     # Open file
-    with h5py.File(filename, 'r') as f:
+    with _stage('open'):
+        f = h5py.File(filename, 'r')
+    with f:
         # Extract size information
         max_level = f.attrs['MaxLevel']
         if level is None:
@@ -189,6 +220,9 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                 raise AthenaError('Coordinates not recognized')
 
         # Set cell center functions for preset coordinates
+        preset_coordinates = all(func is None for func in (face_func_1, face_func_2,
+                                                           face_func_3, center_func_1,
+                                                           center_func_2, center_func_3))
         if center_func_1 is None:
             if (coord == 'cartesian' or coord == 'minkowski' or coord == 'tilted'
                     or coord == 'sinusoidal' or coord == 'kerr-schild'):
@@ -235,10 +269,6 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                 raise AthenaError('Coordinates not recognized')
 
         # Check output level compared to max level in file
-        if level < max_level and not subsample and not fast_restrict:
-            warnings.warn('Exact restriction being used: performance severely affected;'
-                          + ' see documentation', AthenaWarning)
-            sys.stderr.flush()
         if level > max_level:
             warnings.warn('Requested refinement level higher than maximum level in file:'
                           + ' all cells will be prolongated', AthenaWarning)
@@ -275,7 +305,7 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                     error_string = ('Quantity not recognized: file does not include "{0}"'
                                     + ' but does include {1}')
                     raise AthenaError(error_string.format(q, possibilities))
-        quantities = [str(q) for q in quantities if q not in coord_quantities
+        quantities = [str(q) for q in dict.fromkeys(quantities) if q not in coord_quantities
                       and q not in attr_quantities and q not in other_quantities]
 
         # Store file attribute metadata
@@ -311,13 +341,25 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
         x3m = f['x3f'][fine_block, 0]
         x3p = f['x3f'][fine_block, 1]
 
-        # Populate coordinate arrays
+        # Populate coordinate arrays, reusing them for files on the same grid
+        coordinate_key = None
+        if preset_coordinates:
+            coordinate_key = (coord, level, num_ghost, bool(np.all(levels == level)),
+                              tuple(root_grid_size), tuple(block_size),
+                              tuple(tuple(f.attrs['RootGridX' + repr(d)])
+                                    for d in range(1, 4)),
+                              (x1m, x1p, x2m, x2p, x3m, x3p))
+        cached_coordinates = _coordinate_cache.get(coordinate_key)
         face_funcs = (face_func_1, face_func_2, face_func_3)
         center_funcs = (center_func_1, center_func_2, center_func_3)
         for d, nx, face_func, center_func in zip(range(1, 4), nx_vals, face_funcs,
                                                  center_funcs):
             xf = 'x' + repr(d) + 'f'
             xv = 'x' + repr(d) + 'v'
+            if cached_coordinates is not None:
+                data[xf] = cached_coordinates[xf].copy()
+                data[xv] = cached_coordinates[xv].copy()
+                continue
             if nx == 1:
                 xm = (x1m, x2m, x3m)[d-1]
                 xp = (x1p, x2p, x3p)[d-1]
@@ -355,9 +397,12 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                     xrat = xrat_root ** (1.0 / 2**level)
                     data[xf] = (xmin + (1.0-xrat**np.arange(nx+1))
                                 / (1.0-xrat**nx) * (xmax-xmin))
-            data[xv] = np.empty(nx)
-            for i in range(nx):
-                data[xv][i] = center_func(data[xf][i], data[xf][i+1])
+            data[xv] = np.asarray(center_func(data[xf][:-1], data[xf][1:]), dtype=float)
+        if coordinate_key is not None and cached_coordinates is None:
+            if len(_coordinate_cache) >= coordinate_cache_size:
+                _coordinate_cache.clear()
+            _coordinate_cache[coordinate_key] = {key: data[key].copy()
+                                                 for key in coord_quantities}
 
         # Account for selection
         x1_select = False
@@ -428,8 +473,38 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
         if not subsample and not fast_restrict and max_level > level:
             restricted_data = np.zeros((lx3, lx2, lx1), dtype=bool)
 
-        # Go through blocks in data file
-        for block_num in range(num_blocks):
+        # Fast path for uniform-level, full-domain reads: every block maps one-to-one
+        # onto a slab of the output, so all blocks of a quantity are read at once and
+        # scattered by logical location in a single pass
+        uniform_blocks = (np.all(levels == level) and num_ghost == 0
+                          and not (x1_select or x2_select or x3_select)
+                          and num_blocks == lx1 * lx2 * lx3
+                          and all(block_size[d] > 1 or root_grid_size[d] == 1
+                                  for d in range(3)))
+        if uniform_blocks:
+            loc1 = logical_locations[:, 0]
+            loc2 = logical_locations[:, 1]
+            loc3 = logical_locations[:, 2]
+            for q, dataset, index in zip(quantities, quantity_datasets,
+                                         quantity_indices):
+                blocks_view = data[q].reshape(lx3, block_size[2], lx2, block_size[1],
+                                              lx1, block_size[0]).transpose(0, 2, 4,
+                                                                            1, 3, 5)
+                with _stage('read') as record:
+                    values = f[dataset][index]
+                    record['bytes'] = values.nbytes
+                with _stage('merge'):
+                    blocks_view[loc3, loc2, loc1] = values
+                del values
+            if return_levels:
+                data['Levels'].fill(level)
+
+        # Work out which blocks intersect the selection, and for each the destination
+        # indices, the (prolongated or restricted) source indices and the native
+        # hyperslab of the block that has to be read
+        block_plans = []
+        skip_blocks = uniform_blocks or (not quantities and not return_levels)
+        for block_num in (() if skip_blocks else range(num_blocks)):
             # Extract location information
             block_level = levels[block_num]
             block_location = logical_locations[block_num, :]
@@ -450,41 +525,6 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                 ju_d = jl_d + block_size[1] * s if nx2 > 1 else 1
                 ku_d = kl_d + block_size[2] * s if nx3 > 1 else 1
 
-                # Calculate (prolongated) source indices, with selection
-                il_s = max(il_d, i_min) - il_d
-                jl_s = max(jl_d, j_min) - jl_d
-                kl_s = max(kl_d, k_min) - kl_d
-                iu_s = min(iu_d, i_max) - il_d
-                ju_s = min(ju_d, j_max) - jl_d
-                ku_s = min(ku_d, k_max) - kl_d
-                if il_s >= iu_s or jl_s >= ju_s or kl_s >= ku_s:
-                    continue
-
-                # Account for selection in destination indices
-                il_d = max(il_d, i_min) - i_min
-                jl_d = max(jl_d, j_min) - j_min
-                kl_d = max(kl_d, k_min) - k_min
-                iu_d = min(iu_d, i_max) - i_min
-                ju_d = min(ju_d, j_max) - j_min
-                ku_d = min(ku_d, k_max) - k_min
-
-                # Assign values
-                for q, dataset, index in zip(quantities, quantity_datasets,
-                                             quantity_indices):
-                    block_data = f[dataset][index, block_num, :]
-                    if s > 1:
-                        if nx1 > 1:
-                            block_data = np.repeat(block_data, s, axis=2)[:, :, il_s:iu_s]
-                        if nx2 > 1:
-                            block_data = np.repeat(block_data, s, axis=1)[:, jl_s:ju_s, :]
-                        if nx3 > 1:
-                            block_data = np.repeat(block_data, s, axis=0)[kl_s:ku_s, :, :]
-                        data[q][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] = block_data
-                    else:
-                        data[q][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] = block_data[kl_s:ku_s,
-                                                                              jl_s:ju_s,
-                                                                              il_s:iu_s]
-
             # Restrict fine data
             else:
                 # Calculate scale
@@ -498,150 +538,211 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
                 ju_d = jl_d + block_size[1] // s if nx2 > 1 else 1
                 ku_d = kl_d + block_size[2] // s if nx3 > 1 else 1
 
-                # Calculate (restricted) source indices, with selection
-                il_s = max(il_d, i_min) - il_d
-                jl_s = max(jl_d, j_min) - jl_d
-                kl_s = max(kl_d, k_min) - kl_d
-                iu_s = min(iu_d, i_max) - il_d
-                ju_s = min(ju_d, j_max) - jl_d
-                ku_s = min(ku_d, k_max) - kl_d
-                if il_s >= iu_s or jl_s >= ju_s or kl_s >= ku_s:
-                    continue
-
-                # Account for selection in destination indices
-                il_d = max(il_d, i_min) - i_min
-                jl_d = max(jl_d, j_min) - j_min
-                kl_d = max(kl_d, k_min) - k_min
-                iu_d = min(iu_d, i_max) - i_min
-                ju_d = min(ju_d, j_max) - j_min
-                ku_d = min(ku_d, k_max) - k_min
-
+            # Calculate (prolongated or restricted) source indices, with selection
+            il_s = max(il_d, i_min) - il_d
+            jl_s = max(jl_d, j_min) - jl_d
+            kl_s = max(kl_d, k_min) - kl_d
+            iu_s = min(iu_d, i_max) - il_d
+            ju_s = min(ju_d, j_max) - jl_d
+            ku_s = min(ku_d, k_max) - kl_d
+            if il_s >= iu_s or jl_s >= ju_s or kl_s >= ku_s:
+                continue
+
+            # Account for selection in destination indices
+            il_d = max(il_d, i_min) - i_min
+            jl_d = max(jl_d, j_min) - j_min
+            kl_d = max(kl_d, k_min) - k_min
+            iu_d = min(iu_d, i_max) - i_min
+            ju_d = min(ju_d, j_max) - j_min
+            ku_d = min(ku_d, k_max) - k_min
+
+            # Calculate native source indices covering the selection, so that only the
+            # needed hyperslab of the block is read from the file
+            s1 = s if nx1 > 1 else 1
+            s2 = s if nx2 > 1 else 1
+            s3 = s if nx3 > 1 else 1
+            if block_level <= level:
+                box = (kl_s // s3, -(-ku_s // s3), jl_s // s2, -(-ju_s // s2),
+                       il_s // s1, -(-iu_s // s1))
+            else:
                 # Account for restriction in source indices
-                if nx1 > 1:
-                    il_s *= s
-                    iu_s *= s
-                if nx2 > 1:
-                    jl_s *= s
-                    ju_s *= s
-                if nx3 > 1:
-                    kl_s *= s
-                    ku_s *= s
-
-                # Apply subsampling
-                if subsample:
-                    # Calculate fine-level offsets (nearest cell at or below center)
-                    o1 = s//2 - 1 if nx1 > 1 else 0
-                    o2 = s//2 - 1 if nx2 > 1 else 0
-                    o3 = s//2 - 1 if nx3 > 1 else 0
-
-                    # Assign values
-                    for q, dataset, index in zip(quantities, quantity_datasets,
-                                                 quantity_indices):
-                        data[q][kl_d:ku_d,
-                                jl_d:ju_d,
-                                il_d:iu_d] = f[dataset][index, block_num, kl_s+o3:ku_s:s,
-                                                        jl_s+o2:ju_s:s, il_s+o1:iu_s:s]
-
-                # Apply fast (uniform Cartesian) restriction
-                elif fast_restrict:
-                    # Calculate fine-level offsets
-                    io_vals = range(s) if nx1 > 1 else (0,)
-                    jo_vals = range(s) if nx2 > 1 else (0,)
-                    ko_vals = range(s) if nx3 > 1 else (0,)
-
-                    # Assign values
-                    for q, dataset, index in zip(quantities, quantity_datasets,
-                                                 quantity_indices):
-                        for ko in ko_vals:
-                            for jo in jo_vals:
-                                for io in io_vals:
-                                    data[q][kl_d:ku_d,
-                                            jl_d:ju_d,
-                                            il_d:iu_d] += f[dataset][index, block_num,
-                                                                     kl_s+ko:ku_s:s,
-                                                                     jl_s+jo:ju_s:s,
-                                                                     il_s+io:iu_s:s]
-                        data[q][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] /= s ** num_extended_dims
-
-                # Apply exact (volume-weighted) restriction
-                else:
-                    # Calculate sets of indices
-                    i_s_vals = range(il_s, iu_s)
-                    j_s_vals = range(jl_s, ju_s)
-                    k_s_vals = range(kl_s, ku_s)
-                    i_d_vals = range(il_d, iu_d)
-                    j_d_vals = range(jl_d, ju_d)
-                    k_d_vals = range(kl_d, ku_d)
-                    if nx1 > 1:
-                        i_d_vals = np.repeat(i_d_vals, s)
-                    if nx2 > 1:
-                        j_d_vals = np.repeat(j_d_vals, s)
-                    if nx3 > 1:
-                        k_d_vals = np.repeat(k_d_vals, s)
-
-                    # Accumulate values
-                    for k_s, k_d in zip(k_s_vals, k_d_vals):
-                        if nx3 > 1:
-                            x3m = f['x3f'][block_num, k_s]
-                            x3p = f['x3f'][block_num, k_s+1]
-                        for j_s, j_d in zip(j_s_vals, j_d_vals):
-                            if nx2 > 1:
-                                x2m = f['x2f'][block_num, j_s]
-                                x2p = f['x2f'][block_num, j_s+1]
-                            for i_s, i_d in zip(i_s_vals, i_d_vals):
+                il_s *= s1
+                iu_s *= s1
+                jl_s *= s2
+                ju_s *= s2
+                kl_s *= s3
+                ku_s *= s3
+                box = (kl_s, ku_s, jl_s, ju_s, il_s, iu_s)
+
+            block_plans.append((block_num, block_level, s, box,
+                                (kl_d, ku_d, jl_d, ju_d, il_d, iu_d),
+                                (kl_s, ku_s, jl_s, ju_s, il_s, iu_s)))
+
+        # Group blocks into runs of consecutive blocks sharing the same hyperslab, so
+        # that each run is read with one hyperslab per dataset covering all needed
+        # variables; runs are capped at block_run_bytes
+        dataset_variables = {}
+        for dataset, index in zip(quantity_datasets, quantity_indices):
+            dataset_variables.setdefault(dataset, set()).add(index)
+        dataset_variables = {dataset: sorted(indices)
+                             for dataset, indices in dataset_variables.items()}
+        quantity_positions = [dataset_variables[dataset].index(index)
+                              for dataset, index in zip(quantity_datasets,
+                                                        quantity_indices)]
+        bytes_per_cell = np.dtype(dtype).itemsize * max(len(quantities), 1)
+        block_runs = []
+        for plan in block_plans:
+            box = plan[3]
+            cells = (box[1]-box[0]) * (box[3]-box[2]) * (box[5]-box[4])
+            max_run = max(block_run_bytes // (cells * bytes_per_cell), 1)
+            last = block_runs[-1][-1] if block_runs else None
+            if (last is not None and plan[0] == last[0] + 1 and box == last[3]
+                    and len(block_runs[-1]) < max_run):
+                block_runs[-1].append(plan)
+            else:
+                block_runs.append([plan])
+
+        # Read block faces once for exact restriction
+        if not subsample and not fast_restrict and max_level > level:
+            x1f_blocks = f['x1f'][:] if nx1 > 1 else None
+            x2f_blocks = f['x2f'][:] if nx2 > 1 else None
+            x3f_blocks = f['x3f'][:] if nx3 > 1 else None
+
+        # Go through blocks in data file
+        for block_run in block_runs:
+            # Read the hyperslab of every block in the run for all needed variables
+            run_start = block_run[0][0]
+            run_end = block_run[-1][0] + 1
+            kl_n, ku_n, jl_n, ju_n, il_n, iu_n = block_run[0][3]
+            run_data = {}
+            with _stage('read') as record:
+                for dataset, indices in dataset_variables.items():
+                    if indices[-1] - indices[0] + 1 == len(indices):
+                        variable_selection = slice(indices[0], indices[-1] + 1)
+                    else:
+                        variable_selection = indices
+                    run_data[dataset] = f[dataset][variable_selection, run_start:run_end,
+                                                   kl_n:ku_n, jl_n:ju_n, il_n:iu_n]
+                record['bytes'] = sum(values.nbytes for values in run_data.values())
+
+            with _stage('merge'):
+                for block_num, block_level, s, box, dest, source in block_run:
+                    kl_d, ku_d, jl_d, ju_d, il_d, iu_d = dest
+                    kl_s, ku_s, jl_s, ju_s, il_s, iu_s = source
+                    block_values = [run_data[dataset][position, block_num - run_start]
+                                    for dataset, position in zip(quantity_datasets,
+                                                                 quantity_positions)]
+
+                    # Prolongate coarse data and copy same-level data
+                    if block_level <= level:
+                        # Assign values
+                        for q, block_data in zip(quantities, block_values):
+                            if s > 1:
                                 if nx1 > 1:
-                                    x1m = f['x1f'][block_num, i_s]
-                                    x1p = f['x1f'][block_num, i_s+1]
-                                vol = vol_func(x1m, x1p, x2m, x2p, x3m, x3p)
-                                for q, dataset, index in zip(quantities,
-                                                             quantity_datasets,
-                                                             quantity_indices):
-                                    data[q][k_d, j_d, i_d] += vol * f[dataset][index,
-                                                                               block_num,
-                                                                               k_s, j_s,
-                                                                               i_s]
-                    loc1 = (nx1 > 1) * block_location[0] // s
-                    loc2 = (nx2 > 1) * block_location[1] // s
-                    loc3 = (nx3 > 1) * block_location[2] // s
-                    restricted_data[loc3, loc2, loc1] = True
-
-            # Set level information for cells in this block
-            if return_levels:
-                data['Levels'][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] = block_level
+                                    block_data = np.repeat(block_data, s, axis=2)[
+                                        :, :, il_s-box[4]*s:iu_s-box[4]*s]
+                                if nx2 > 1:
+                                    block_data = np.repeat(block_data, s, axis=1)[
+                                        :, jl_s-box[2]*s:ju_s-box[2]*s, :]
+                                if nx3 > 1:
+                                    block_data = np.repeat(block_data, s, axis=0)[
+                                        kl_s-box[0]*s:ku_s-box[0]*s, :, :]
+                            data[q][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] = block_data
+
+                    # Apply subsampling
+                    elif subsample:
+                        # Calculate fine-level offsets (nearest cell at or below center)
+                        o1 = s//2 - 1 if nx1 > 1 else 0
+                        o2 = s//2 - 1 if nx2 > 1 else 0
+                        o3 = s//2 - 1 if nx3 > 1 else 0
+
+                        # Assign values
+                        for q, block_data in zip(quantities, block_values):
+                            data[q][kl_d:ku_d,
+                                    jl_d:ju_d,
+                                    il_d:iu_d] = block_data[o3::s, o2::s, o1::s]
+
+                    # Apply fast (uniform Cartesian) restriction
+                    elif fast_restrict:
+                        # Calculate fine-level offsets
+                        io_vals = range(s) if nx1 > 1 else (0,)
+                        jo_vals = range(s) if nx2 > 1 else (0,)
+                        ko_vals = range(s) if nx3 > 1 else (0,)
+
+                        # Assign values
+                        for q, block_data in zip(quantities, block_values):
+                            for ko in ko_vals:
+                                for jo in jo_vals:
+                                    for io in io_vals:
+                                        data[q][kl_d:ku_d,
+                                                jl_d:ju_d,
+                                                il_d:iu_d] += block_data[ko::s, jo::s,
+                                                                         io::s]
+                            data[q][kl_d:ku_d,
+                                    jl_d:ju_d,
+                                    il_d:iu_d] /= s ** num_extended_dims
+
+                    # Apply exact (volume-weighted) restriction
+                    else:
+                        # Calculate fine-cell volumes from the block faces, broadcast over
+                        # [k, j, i]; unextended dimensions use the fine-block faces
+                        if nx1 > 1:
+                            x1_faces = x1f_blocks[block_num, il_s:iu_s+1]
+                        else:
+                            x1_faces = np.array([x1m, x1p])
+                        if nx2 > 1:
+                            x2_faces = x2f_blocks[block_num, jl_s:ju_s+1]
+                        else:
+                            x2_faces = np.array([x2m, x2p])
+                        if nx3 > 1:
+                            x3_faces = x3f_blocks[block_num, kl_s:ku_s+1]
+                        else:
+                            x3_faces = np.array([x3m, x3p])
+                        vol = vol_func(x1_faces[None, None, :-1],
+                                       x1_faces[None, None, 1:],
+                                       x2_faces[None, :-1, None],
+                                       x2_faces[None, 1:, None],
+                                       x3_faces[:-1, None, None],
+                                       x3_faces[1:, None, None])
+
+                        # Accumulate volume-weighted values, summing each group of fine
+                        # cells onto its coarse cell
+                        s1 = s if nx1 > 1 else 1
+                        s2 = s if nx2 > 1 else 1
+                        s3 = s if nx3 > 1 else 1
+                        coarse_shape = (ku_d-kl_d, s3, ju_d-jl_d, s2, iu_d-il_d, s1)
+                        for q, block_data in zip(quantities, block_values):
+                            data[q][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] += (
+                                (vol * block_data).reshape(coarse_shape)
+                                .sum(axis=(1, 3, 5)))
+                        block_location = logical_locations[block_num, :]
+                        loc1 = (nx1 > 1) * block_location[0] // s
+                        loc2 = (nx2 > 1) * block_location[1] // s
+                        loc3 = (nx3 > 1) * block_location[2] // s
+                        restricted_data[loc3, loc2, loc1] = True
+
+                    # Set level information for cells in this block
+                    if return_levels:
+                        data['Levels'][kl_d:ku_d, jl_d:ju_d, il_d:iu_d] = block_level
 
     # Remove volume factors from restricted data
     if level < max_level and not subsample and not fast_restrict:
-        for loc3 in range(lx3):
-            for loc2 in range(lx2):
-                for loc1 in range(lx1):
-                    if restricted_data[loc3, loc2, loc1]:
-                        il = loc1 * block_size[0]
-                        jl = loc2 * block_size[1]
-                        kl = loc3 * block_size[2]
-                        iu = il + block_size[0]
-                        ju = jl + block_size[1]
-                        ku = kl + block_size[2]
-                        il = max(il, i_min) - i_min
-                        jl = max(jl, j_min) - j_min
-                        kl = max(kl, k_min) - k_min
-                        iu = min(iu, i_max) - i_min
-                        ju = min(ju, j_max) - j_min
-                        ku = min(ku, k_max) - k_min
-                        for k in range(kl, ku):
-                            if nx3 > 1:
-                                x3m = data['x3f'][k]
-                                x3p = data['x3f'][k+1]
-                            for j in range(jl, ju):
-                                if nx2 > 1:
-                                    x2m = data['x2f'][j]
-                                    x2p = data['x2f'][j+1]
-                                for i in range(il, iu):
-                                    if nx1 > 1:
-                                        x1m = data['x1f'][i]
-                                        x1p = data['x1f'][i+1]
-                                    vol = vol_func(x1m, x1p, x2m, x2p, x3m, x3p)
-                                    for q in quantities:
-                                        data[q][k, j, i] /= vol
+        # Expand restricted block flags to cells and apply the selection
+        restricted_cells = np.repeat(np.repeat(np.repeat(restricted_data, block_size[2],
+                                                         axis=0),
+                                               block_size[1], axis=1),
+                                     block_size[0], axis=2)[k_min:k_max, j_min:j_max,
+                                                            i_min:i_max]
+        if restricted_cells.any():
+            x1f = data['x1f']
+            x2f = data['x2f']
+            x3f = data['x3f']
+            vol = vol_func(x1f[None, None, :-1], x1f[None, None, 1:],
+                           x2f[None, :-1, None], x2f[None, 1:, None],
+                           x3f[:-1, None, None], x3f[1:, None, None])
+            vol = np.broadcast_to(vol, restricted_cells.shape)[restricted_cells]
+            for q in quantities:
+                data[q][restricted_cells] /= vol
 
     # Return dictionary containing requested data arrays
     if check_nan_flag:
@@ -653,6 +754,62 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
 
 # ========================================================================================
 
+def athdf_grid(filename, level=None, num_ghost=0, **kwargs):
+    """Read the grid of an .athdf file without touching any cell data.
+
+    Only the HDF5 headers and coordinate datasets are read. Returns a dictionary with
+    the file attributes, the merged coordinates x1f..x3v as athdf() would return them,
+    the block layout ('Levels' and 'LogicalLocations' per MeshBlock) and the decoded
+    variable names ('Quantities'). Coordinate keyword arguments (face_func_1,
+    center_func_1, ...) are passed on to athdf().
+    """
+
+    # Load HDF5 reader
+    import h5py
+
+    data = athdf(filename, quantities=[], level=level, num_ghost=num_ghost, **kwargs)
+    with h5py.File(filename, 'r') as f:
+        data['Levels'] = f['Levels'][:]
+        data['LogicalLocations'] = f['LogicalLocations'][:]
+    data['Quantities'] = [x.decode('ascii', 'replace') for x in data['VariableNames']]
+    return data
+
+
+# ========================================================================================
+
+def athdf_x1_shells(filename, indices, halo=0, x1f=None, **kwargs):
+    """Read .athdf file keeping only the x1 cells around the given indices.
+
+    The cells spanned by indices, widened by halo cells on each side, are converted
+    into x1_min/x1_max face values, so MeshBlocks outside the range are skipped and
+    only the needed hyperslab of each remaining block is read. Negative indices count
+    from the outer boundary. The x1 faces of the whole grid can be passed as x1f
+    (e.g. from a cache of the grid), otherwise the grid is read from the file first.
+    Other keyword arguments are passed on to athdf().
+
+    Returns the data dictionary and the indices relative to the x1 range read.
+    """
+
+    # Read the grid only to locate the faces bounding the range
+    if x1f is None:
+        grid = athdf_grid(filename, level=kwargs.get('level'),
+                          num_ghost=kwargs.get('num_ghost', 0))
+        x1f = grid['x1f']
+    nx1 = len(x1f) - 1
+    indices = np.atleast_1d(np.asarray(indices, dtype=int))
+    if np.any(indices < -nx1) or np.any(indices >= nx1):
+        raise AthenaError('x1 index out of range for {0} cells'.format(nx1))
+    indices = indices % nx1
+
+    # Clamp the range to the grid and shift the indices accordingly
+    i_min = max(int(indices.min()) - halo, 0)
+    i_max = min(int(indices.max()) + 1 + halo, nx1)
+    data = athdf(filename, x1_min=x1f[i_min], x1_max=x1f[i_max], **kwargs)
+    return data, indices - i_min
+
+
+# ========================================================================================
+
 class AthenaError(RuntimeError):
     """General exception class for Athena++ read functions."""
     pass
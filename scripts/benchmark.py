@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmark.py
+End-to-end benchmark of the analysis pipeline on synthetic snapshots.
+
+For every grid size a series of snapshots is written with synthetic.py, then
+each stage is timed on its own:
+    read            athena_read.athdf_x1_shells of the radial window a worker reads
+    read_full       athena_read.athdf of the whole file
+    kernel          worker.shell_divergence on data already in memory
+    kernel_float32  the same in float32 precision
+    accretion_rate  accRate.run_program (read and reduction of one file)
+    reduction       folding every file's map into the running mean and profile
+    plot            plot.plot_data with a non-interactive backend
+and both controllers' worker pools are timed end to end for each worker count
+    dissipation     script.stream_results over worker.run_program, with the geometry cached
+    dissipation_cold  the same, building the geometry cache in every run
+    accretion       script.stream_results over accRate.run_program
+and the memory of a worker is checked against its estimate for every
+--worker-mem budget
+    memory          growth of the peak RSS of a fresh process running
+                    worker.run_program on the whole grid within the budget,
+                    against worker.task_bytes (float64 and float32)
+The benchmark exits with status 1 when a worker outgrows its estimate.
+
+The results are written as JSON, with the machine and library versions, so
+runs can be compared for regressions. The geometry cache of the workers is
+pointed at a temporary directory for the run, so the user's cache is left
+untouched.
+
+Usage: python benchmark.py --grids 32x32x32 64x64x64 --workers 1 2 4 -o bench.json
+"""
+
+# IMPORTS
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+from statistics import median
+from concurrent.futures import ProcessPoolExecutor
+
+# Non-interactive plotting, set before plot.py imports pyplot
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+# Custom Helper Modules
+import athena_read
+import accRate
+import accRateScript
+import geometry
+import plot
+import reducer
+import resources
+import script
+import synthetic
+import worker
+
+# Other Python modules
+import numpy as np
+import h5py
+
+
+"""
+Parses a grid argument NRxNTHETAxNPHI, e.g. 64x128x256.
+Returns: (nr, ntheta, nphi)
+"""
+def grid_spec(value):
+    try:
+        nr, ntheta, nphi = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid grid, use NRxNTHETAxNPHI.")
+    return nr, ntheta, nphi
+
+
+"""
+Silences stdout and stderr at the file descriptor level, so the progress
+messages of the workers (including child processes) do not skew the timings.
+"""
+@contextlib.contextmanager
+def quiet():
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (devnull,):
+            os.close(fd)
+
+
+"""
+Calls fn repeats times.
+Optional: setup=None (called untimed before every call)
+Returns: list of the elapsed seconds of every call
+"""
+def time_call(fn, repeats, setup=None):
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        with quiet():
+            fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+"""
+Writes the snapshots of one grid, or reuses them if they already exist.
+Argument(s): directory (str), grid (nr, ntheta, nphi), n_files (int), block (int)
+Optional: x1=(1.0, 10.0) radial extent and optionally x1rat, see synthetic.write
+Returns: list of paths
+"""
+def make_dataset(directory, grid, n_files, block, x1=(1.0, 10.0)):
+    block_size = tuple(min(block, n) for n in grid)
+    if any(n % b for n, b in zip(grid, block_size)):
+        raise ValueError(f"Grid {grid} is not a multiple of the MeshBlock size {block_size}.")
+    root_blocks = tuple(n // b for n, b in zip(grid, block_size))
+
+    paths = [os.path.join(directory, f"disk.out1.{n:05d}.athdf") for n in range(n_files)]
+    if not all(os.path.exists(path) for path in paths):
+        paths = synthetic.write_series(directory, n_files, block_size=block_size, root_blocks=root_blocks, x1=x1)
+    return paths
+
+
+"""
+Reads the peak resident memory (VmHWM) of this process.
+Returns: int bytes
+"""
+def peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("No VmHWM in /proc/self/status")
+
+
+"""
+Runs worker.run_program on the whole radial range of a file within max_bytes
+and returns how much the peak memory of the process grew. The peak is reset
+first, after the geometry and the modules are loaded.
+Argument(s): file_path (str), radius (int), max_bytes (int), float32 (bool)
+Returns: int bytes
+"""
+def _peak_growth(file_path, radius, max_bytes, float32):
+    geometry.load(file_path)
+    athena_read.athdf_grid(file_path)
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5") # resets VmHWM to the current RSS
+    start = peak_rss()
+    with quiet():
+        worker.run_program(file_path, [radius], shell=False, max_bytes=max_bytes, float32=float32)
+    return peak_rss() - start
+
+
+"""
+Same as _peak_growth, in a fresh process so that the earlier stages do not
+hold the peak. Linux only.
+Returns: int bytes, or None where /proc is not available
+"""
+def peak_growth(file_path, radius, max_bytes, float32=False):
+    if not os.path.exists("/proc/self/clear_refs"):
+        return None
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_peak_growth, file_path, radius, max_bytes, float32).result()
+
+
+"""
+Runs every stage on one grid.
+Argument(s): paths (list of str), grid (tuple), workers (list of int), repeats (int)
+Optional: budgets=() (--worker-mem budgets in bytes for the memory check)
+Returns: list of result dicts
+"""
+def bench_grid(paths, grid, workers, repeats, budgets=()):
+    label = "x".join(map(str, grid))
+    radius = grid[0] // 2
+    first = paths[0]
+    file_bytes = os.path.getsize(first)
+    results = []
+
+    def record(stage, seconds, n_workers=1, nbytes=None):
+        result = {"grid": label, "files": len(paths), "stage": stage, "workers": n_workers,
+                  "repeats": len(seconds), "seconds": seconds,
+                  "min": min(seconds), "median": median(seconds)}
+        if nbytes is not None:
+            result["bytes"] = nbytes
+            result["throughput_MBps"] = nbytes / min(seconds) / 2**20
+        results.append(result)
+        print(f"{label:>14} {stage:>15} workers={n_workers:<3} min {result['min']:.4f} s  "
+              f"median {result['median']:.4f} s", file=sys.stderr)
+
+    # Single-file stages
+    x1f = geometry.load(first)['r_f'] # the faces a worker takes from the geometry cache
+    read = lambda: athena_read.athdf_x1_shells(first, radius, halo=1, x1f=x1f, quantities=worker.QUANTITIES)
+    record("read", time_call(read, repeats))
+    record("read_full", time_call(lambda: athena_read.athdf(first, quantities=worker.QUANTITIES), repeats),
+           nbytes=file_bytes)
+
+    data, local = read()
+    args = (data['Fr1'], data['Fr2'], data['Fr3'], data['x1v'], data['x2v'], data['x3v'], int(local[0]))
+    record("kernel", time_call(lambda: worker.shell_divergence(*args), repeats))
+    record("kernel_float32", time_call(lambda: worker.shell_divergence(*args, float32=True), repeats))
+    record("accretion_rate", time_call(lambda: accRate.run_program(first, radius), repeats))
+
+    # Reduction of every file's map, and the plot of the profile
+    result = worker.shell_divergence(*args)[np.newaxis]
+    phi, theta = data['x3v'], data['x2v']
+    def reduce():
+        avg_map = reducer.RunningMean(result.shape)
+        avg_profile = reducer.RunningMean((1, len(theta)), variance=True)
+        for _ in paths:
+            avg_map.add(result)
+            avg_profile.add(plot.scale_wrt_theta(result, phi))
+        return plot.scale_wrt_theta(avg_map.mean(), phi)
+    record("reduction", time_call(reduce, repeats))
+    profile = reduce()[0]
+    def draw():
+        plot.plot_data(theta / np.pi, profile, rad=radius)
+        plt.close("all")
+    record("plot", time_call(draw, repeats))
+
+    # Worker pools end to end. The cold runs start from an empty geometry 
+    # cache, the warm runs find it built.
+    shape = (1, len(phi), len(theta))
+    clear_geometry = lambda: shutil.rmtree(geometry.cache_dir(), ignore_errors=True)
+    for n_workers in workers:
+        run = lambda: list(script.stream_results(script.run_worker, paths, shape, n_workers=n_workers, radius=[radius]))
+        record("dissipation_cold", time_call(run, repeats, setup=clear_geometry), n_workers,
+               nbytes=file_bytes * len(paths))
+        record("dissipation", time_call(run, repeats, setup=lambda: geometry.load(first)), n_workers,
+               nbytes=file_bytes * len(paths))
+        run = lambda: list(script.stream_results(accRateScript.run_worker, paths, (), n_workers=n_workers, radius=radius))
+        record("accretion", time_call(run, repeats), n_workers, nbytes=file_bytes * len(paths))
+
+    # Peak memory of a worker within each budget, against the estimate the 
+    # pool is sized with
+    for max_bytes in budgets:
+        for float32 in (False, True):
+            growth = peak_growth(first, radius, max_bytes, float32)
+            if growth is None:
+                continue
+            estimate = worker.task_bytes(geometry.grid_shape(geometry.load(first)), [radius], shell=False,
+                                         max_bytes=max_bytes, float32=float32)
+            results.append({"grid": label, "stage": "memory", "budget": max_bytes, "float32": float32,
+                            "peak_growth": growth, "estimate": estimate, "within_estimate": growth <= estimate})
+            print(f"{label:>14} {'memory':>15} budget {max_bytes / 2**20:.0f} MB{' float32' if float32 else ''}: "
+                  f"peak grew {growth / 2**20:.1f} MB, estimate {estimate / 2**20:.1f} MB", file=sys.stderr)
+    return results
+
+
+"""
+Describes the machine and the code the benchmark ran on.
+"""
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit or None,
+            "platform": platform.platform(), "python": platform.python_version(),
+            "numpy": np.__version__, "h5py": h5py.__version__, "cpu_count": os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic snapshots.")
+    parser.add_argument("--grids", type=grid_spec, nargs="+", default=[(32, 32, 32), (64, 64, 64)],
+    help="Grid sizes NRxNTHETAxNPHI (default: 32x32x32 64x64x64).")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+    help="Worker counts for the end-to-end runs (default: 1 and one per core).")
+    parser.add_argument("-n", "--files", type=int, default=4, help="Snapshots per grid (default: 4).")
+    parser.add_argument("--block", type=int, default=16, help="Cells per MeshBlock side (default: 16).")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Timed runs per stage (default: 3).")
+    parser.add_argument("--x1", type=float, nargs="+", default=(1.0, 10.0), metavar="X",
+    help="Radial extent and optionally x1rat of the snapshots, as RMIN RMAX [RATIO] "
+         "(default: 1 10, ratio (RMAX/RMIN)^(1/NR)).")
+    parser.add_argument("--worker-mem", type=resources.memory_spec, nargs="+", default=[8 * 2**20, 32 * 2**20],
+    metavar="SIZE", dest="worker_mem",
+    help="Memory budgets of a worker for the memory check, e.g. 8M 32M (default: 8M 32M).")
+    parser.add_argument("--data", help="Keep the snapshots in this directory and reuse them (default: a temporary one).")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file (default: print them).")
+    args = parser.parse_args()
+    if len(args.x1) not in (2, 3):
+        parser.error("--x1 takes RMIN RMAX [RATIO]")
+
+    data_dir = args.data or tempfile.mkdtemp(prefix="athdf-bench-")
+    # Keep the geometry of the synthetic grids out of the user's cache
+    geometry_dir = tempfile.mkdtemp(prefix="athdf-bench-geometry-")
+    saved_cache = os.environ.get("ATHENA_GEOMETRY_CACHE")
+    os.environ["ATHENA_GEOMETRY_CACHE"] = geometry_dir
+    try:
+        results = []
+        for grid in args.grids:
+            name = "x".join(map(str, grid)) + "_r" + "_".join(map(str, args.x1)) # reuse only matching snapshots
+            paths = make_dataset(os.path.join(data_dir, name), grid, args.files, args.block, tuple(args.x1))
+            results.extend(bench_grid(paths, grid, sorted(set(args.workers)), args.repeats, args.worker_mem))
+    finally:
+        if not args.data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        shutil.rmtree(geometry_dir, ignore_errors=True)
+        if saved_cache is None:
+            os.environ.pop("ATHENA_GEOMETRY_CACHE", None)
+        else:
+            os.environ["ATHENA_GEOMETRY_CACHE"] = saved_cache
+
+    report = {"environment": environment(),
+              "settings": {"files": args.files, "block": args.block, "repeats": args.repeats,
+                           "x1": list(args.x1), "worker_mem": args.worker_mem},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+    over = [r for r in results if r["stage"] == "memory" and not r["within_estimate"]]
+    for r in over:
+        print(f"[ERROR] {r['grid']}: a worker within {r['budget'] / 2**20:.0f} MB"
+              f"{' (float32)' if r['float32'] else ''} grew its peak memory by {r['peak_growth'] / 2**20:.1f} MB, "
+              f"more than the estimate of {r['estimate'] / 2**20:.1f} MB", file=sys.stderr)
+    if over:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""geometry.py
+Persistent cache of the spherical grid of a simulation, shared by the
+controllers and all workers.
+
+Each grid is stored once, in a directory named after a hash of the grid
+attributes of the .athdf header (RootGridX1-3, RootGridSize, MeshBlockSize,
+MaxLevel, Coordinates), so a different simulation never picks up a stale
+grid. Every array is a .npy file and is opened memory-mapped, so workers
+share the pages instead of each holding a copy.
+
+Stored arrays:
+    r_f, theta_f, phi_f         cell faces
+    r, theta, phi               cell centers
+    sin_theta                   sin of the theta centers
+    d_r, d_theta, d_phi         cell-centered spacings, zero on the first and last cell
+
+Only 1d arrays are stored. The volume element r^2 sin(theta) d_r d_theta d_phi
+is separable, so volume() builds it from them for just the window or slab a
+worker processes; a stored 3d volume would be paged in by every slice of it.
+
+The cache lives in $ATHENA_GEOMETRY_CACHE if set, otherwise in
+$XDG_CACHE_HOME/accretionDiskVisualization/geometry (~/.cache by default).
+
+Typical Usage:
+    import geometry
+
+    geom = geometry.load(file_path)
+    theta = geom['theta']
+    d_volume = geometry.volume(geometry.radial_slice(geom, lo, hi))
+"""
+
+# IMPORTS
+import os
+import hashlib
+
+# Helper Module
+import athena_read
+import storage
+
+# Other Python Modules
+import numpy as np
+import h5py
+
+# Header attributes that define the grid
+GRID_ATTRIBUTES = ("RootGridX1", "RootGridX2", "RootGridX3", "RootGridSize",
+                   "MeshBlockSize", "MaxLevel", "Coordinates")
+
+# Arrays stored for every grid
+FIELDS = ("r_f", "theta_f", "phi_f", "r", "theta", "phi",
+          "sin_theta", "d_r", "d_theta", "d_phi")
+
+# Bump when the stored arrays change, so old entries are not reused
+CACHE_VERSION = 2
+
+
+"""
+Returns the directory holding the geometry cache.
+"""
+def cache_dir():
+    return storage.cache_path("geometry", "ATHENA_GEOMETRY_CACHE")
+
+
+"""
+Hashes the grid attributes of an .athdf header. Files of the same
+simulation share a key, files of different grids do not.
+Argument(s): file_path (str)
+Returns: str, hex digest
+"""
+def grid_key(file_path):
+    with h5py.File(file_path, "r") as f:
+        return grid_key_from_attrs(f.attrs)
+
+
+"""
+Same as grid_key, for the attributes of an already open file.
+Argument(s): attrs (h5py attributes or dict)
+Returns: str, hex digest
+"""
+def grid_key_from_attrs(attrs):
+    values = []
+    for name in GRID_ATTRIBUTES:
+        value = np.atleast_1d(attrs[name])
+        if value.dtype.kind == "S":
+            value = value.astype(str)
+        values.append(f"{name}={value.tolist()}")
+    values.append(f"version={CACHE_VERSION}")
+    return hashlib.sha256(";".join(values).encode()).hexdigest()[:16]
+
+
+"""
+Computes the cell-centered spacings used by the divergence. The first and
+last entries are left at zero, so cells on the grid boundary drop out of
+the result through a zero volume.
+Arguments: 1d arrays r, theta, phi
+Returns: d_r, d_theta, d_phi, sin_theta
+"""
+def geometry_factors(r, theta, phi):
+    # Initialze arrays
+    d_r = np.zeros_like(r)
+    d_theta = np.zeros_like(theta)
+    d_phi = np.zeros_like(phi)
+
+    # Appropriately adjust these arrays
+    d_r[1:-1] = (r[2:] - r[:-2]) / 2
+    d_theta[1:-1] = (theta[2:] - theta[:-2]) / 2
+    d_phi[1:-1] = (phi[2:] - phi[:-2]) / 2
+    sin_theta = np.sin(theta)
+
+    return d_r, d_theta, d_phi, sin_theta
+
+
+"""
+Computes the volume element r^2 sin(theta) d_r d_theta d_phi.
+Arguments: 1d arrays r, d_r, sin_theta, d_theta, d_phi
+Returns: 3d array of format [phi, theta, r]
+"""
+def volume_element(r, d_r, sin_theta, d_theta, d_phi):
+    r_b = r[np.newaxis, np.newaxis, :]
+    return ((r_b ** 2) * sin_theta[np.newaxis, :, np.newaxis] * d_r[np.newaxis, np.newaxis, :]
+            * d_theta[np.newaxis, :, np.newaxis] * d_phi[:, np.newaxis, np.newaxis])
+
+
+"""
+Reads the grid of file_path (headers and coordinates only) and computes
+every array in FIELDS.
+Argument(s): file_path (str)
+Returns: dict of np.ndarray
+"""
+def compute(file_path):
+    grid = athena_read.athdf_grid(file_path)
+    geom = {"r_f": grid["x1f"], "theta_f": grid["x2f"], "phi_f": grid["x3f"],
+            "r": grid["x1v"], "theta": grid["x2v"], "phi": grid["x3v"]}
+    d_r, d_theta, d_phi, sin_theta = geometry_factors(geom["r"], geom["theta"], geom["phi"])
+    geom.update(sin_theta=sin_theta, d_r=d_r, d_theta=d_theta, d_phi=d_phi)
+    return geom
+
+
+"""
+Builds the volume element of a geometry, e.g. of a window from radial_slice
+or a slab from phi_slice.
+Argument(s): geom (dict from load)
+Returns: 3d array of format [phi, theta, r]
+"""
+def volume(geom):
+    return volume_element(geom["r"], geom["d_r"], geom["sin_theta"], geom["d_theta"], geom["d_phi"])
+
+
+"""
+Returns the shape of the grid of a geometry.
+Argument(s): geom (dict from load)
+Returns: (n_phi, n_theta, n_r)
+"""
+def grid_shape(geom):
+    return len(geom["phi"]), len(geom["theta"]), len(geom["r"])
+
+
+"""
+Returns the cached geometry of the grid file_path belongs to, building the
+cache entry first if it does not exist. Entries are written to a temporary
+directory and renamed into place, so concurrent callers never see a partial
+entry.
+Argument(s): file_path (str)
+Optional: mmap_mode="r" (None loads the arrays into memory)
+Returns: dict of np.ndarray (read-only memory maps by default)
+"""
+def load(file_path, mmap_mode="r"):
+    root = cache_dir()
+    entry = os.path.join(root, grid_key(file_path))
+
+    if not os.path.isdir(entry):
+        def write(tmp):
+            for name, arr in compute(file_path).items():
+                np.save(os.path.join(tmp, name + ".npy"), arr)
+        storage.atomic_write_dir(entry, write)
+
+    return {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode=mmap_mode)
+            for name in FIELDS}
+
+
+"""
+Restricts a geometry to the radial indices start:stop, e.g. the window of
+shells read from a file. The spacings are those of the full grid, so they
+are only zero at the edges of the full grid, not of the window.
+Argument(s): geom (dict from load), start, stop (int)
+Returns: dict of np.ndarray
+"""
+def radial_slice(geom, start, stop):
+    window = dict(geom)
+    window["r_f"] = geom["r_f"][start:stop + 1]
+    window["r"] = geom["r"][start:stop]
+    window["d_r"] = geom["d_r"][start:stop]
+    return window
+
+
+"""
+Restricts a geometry to the phi indices start:stop, e.g. one slab of a
+chunked divergence. As in radial_slice the spacings are those of the full
+grid.
+Argument(s): geom (dict from load), start, stop (int)
+Returns: dict of np.ndarray
+"""
+def phi_slice(geom, start, stop):
+    window = dict(geom)
+    window["phi_f"] = geom["phi_f"][start:stop + 1]
+    window["phi"] = geom["phi"][start:stop]
+    window["d_phi"] = geom["d_phi"][start:stop]
+    return window
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""instrument.py
+Per-stage timing of the pipeline, replacing timer.Timer in the controllers.
+
+Code marks a stage with a span; each span is timed with the monotonic
+time.perf_counter and recorded together with the process id, the file being
+processed and optionally the number of bytes it read. Workers hand their
+records back to the controller with drain(), where a Report aggregates them
+into per-stage statistics (count, total, p50, p95, max, bytes, throughput)
+and per-worker totals. cProfile can be switched on around any section as well.
+
+Stages used by the pipeline:
+    open, read, merge           athena_read.athdf (file open, dataset reads, block merge)
+    divergence                  worker.py
+    accretion_rate              accRate.py
+    ipc                         writing a result to the controller's shared buffer
+    task                        one file end to end in a worker
+    scan, geometry, cache, reduction, plot     controllers
+
+Typical Usage:
+    import instrument
+
+    with instrument.task(file_path):            # worker
+        with instrument.span("read") as record:
+            arr = dataset[...]
+            record["bytes"] = arr.nbytes
+    records = instrument.drain()
+
+    instrument.enable()                         # controller
+    report = instrument.Report()
+    report.add(records)
+    report.show()
+"""
+
+# IMPORTS
+import os
+import json
+import time
+import cProfile
+import contextlib
+
+# Other Python Modules
+import numpy as np
+
+# Records of this process since the last drain()
+_records = []
+
+# File currently processed by this process
+_current_file = None
+
+# Spans are only recorded inside a task or once enable() was called, so that
+# plain use of the instrumented modules (e.g. athena_read in a notebook) does
+# not collect records nobody drains
+_enabled = False
+_task_depth = 0
+
+# Forked workers start with a copy of the controller's records, drop them so
+# that they are not reported twice
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_records.clear)
+
+
+"""
+Times the enclosed block as one span of `stage`. Yields the record, so the
+block can fill in the bytes it read.
+Argument(s): stage (str)
+Yields: dict
+"""
+@contextlib.contextmanager
+def span(stage):
+    record = {"stage": stage, "seconds": 0.0, "bytes": 0,
+              "file": _current_file, "pid": os.getpid()}
+    if not (_enabled or _task_depth):
+        yield record
+        return
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        _records.append(record)
+
+
+"""
+Turns recording of spans outside of tasks on or off in this process. The
+controllers turn it on; tasks are always recorded.
+"""
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+"""
+Marks the enclosed block as the processing of one file: every span inside
+is attributed to file_path, and the whole block is recorded as a "task" span.
+Argument(s): file_path (str)
+"""
+@contextlib.contextmanager
+def task(file_path):
+    global _current_file, _task_depth
+    previous, _current_file = _current_file, file_path
+    _task_depth += 1
+    try:
+        with span("task") as record:
+            yield record
+    finally:
+        _task_depth -= 1
+        _current_file = previous
+
+
+"""
+Returns the records of this process and clears them.
+Returns: list of dict
+"""
+def drain():
+    records = list(_records)
+    _records.clear()
+    return records
+
+
+"""
+Starts cProfile, see stop_profile.
+Returns: cProfile.Profile
+"""
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+"""
+Stops a profiler made by start_profile and dumps its statistics to path,
+to be read with pstats or snakeviz.
+Argument(s): profiler (cProfile.Profile), path (str)
+Returns: None
+"""
+def stop_profile(profiler, path):
+    profiler.disable()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    profiler.dump_stats(path)
+    return None
+
+
+"""
+Profiles the enclosed block with cProfile and dumps the statistics to
+<profile_dir>/<name>.prof. Does nothing when profile_dir is None.
+Argument(s): profile_dir (str or None), name (str)
+"""
+@contextlib.contextmanager
+def profiled(profile_dir, name):
+    if profile_dir is None:
+        yield
+        return
+    profiler = start_profile()
+    try:
+        yield
+    finally:
+        stop_profile(profiler, os.path.join(profile_dir, name + ".prof"))
+
+
+class Report:
+    """
+    Aggregates the span records of the controller and all workers.
+    """
+    def __init__(self):
+        self.records = []
+        self.start = time.perf_counter()
+
+    def add(self, records):
+        self.records.extend(records)
+
+    """
+    Returns the statistics of every stage, in order of first appearance.
+    Returns: dict of stage: dict (count, total, p50, p95, max, bytes, MB_per_s)
+    """
+    def stages(self):
+        grouped = {}
+        for record in self.records:
+            grouped.setdefault(record["stage"], []).append(record)
+
+        stats = {}
+        for stage, records in grouped.items():
+            seconds = np.array([r["seconds"] for r in records])
+            nbytes = sum(r["bytes"] for r in records)
+            stats[stage] = {"count": len(records), "total": float(seconds.sum()),
+                            "p50": float(np.percentile(seconds, 50)),
+                            "p95": float(np.percentile(seconds, 95)),
+                            "max": float(seconds.max()), "bytes": nbytes,
+                            "MB_per_s": nbytes / seconds.sum() / 2**20 if nbytes and seconds.sum() else None}
+        return stats
+
+    """
+    Returns the busy time and number of files of every process that ran tasks.
+    Returns: dict of pid: dict (files, seconds)
+    """
+    def workers(self):
+        workers = {}
+        for record in self.records:
+            if record["stage"] == "task":
+                worker = workers.setdefault(record["pid"], {"files": 0, "seconds": 0.0})
+                worker["files"] += 1
+                worker["seconds"] += record["seconds"]
+        return workers
+
+    """
+    Prints the stage table, the per-worker totals and the wall time since the
+    report was created.
+    """
+    def show(self):
+        print(f"{'stage':<16}{'count':>7}{'total s':>11}{'p50 s':>10}{'p95 s':>10}{'max s':>10}{'MB':>10}{'MB/s':>10}")
+        for stage, s in self.stages().items():
+            mb = f"{s['bytes'] / 2**20:.1f}" if s["bytes"] else "-"
+            rate = f"{s['MB_per_s']:.1f}" if s["MB_per_s"] else "-"
+            print(f"{stage:<16}{s['count']:>7}{s['total']:>11.3f}{s['p50']:>10.4f}{s['p95']:>10.4f}"
+                  f"{s['max']:>10.4f}{mb:>10}{rate:>10}")
+        for pid, w in self.workers().items():
+            print(f"worker {pid}: {w['files']} files in {w['seconds']:.3f} s")
+        print(f"Wall time: {time.perf_counter() - self.start:.3f} s")
+        return None
+
+    """
+    Writes the aggregated statistics and the raw records as JSON.
+    """
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"stages": self.stages(),
+                       "workers": {str(pid): w for pid, w in self.workers().items()},
+                       "records": self.records}, f, indent=2)
+        return None
@@ -165,9 +165,9 @@ def main():
     phi_path = os.path.abspath("phi.npy")
 
     if (not os.path.exists(theta_path)):
-        plot.save_theta(file_list[0])
+        np.save(theta_path, plot.read_theta(file_list[0]))
     if (not os.path.exists(phi_path)):
-        plot.save_phi(file_list[0])
+        np.save(phi_path, plot.read_phi(file_list[0]))
 
     # Create output filename based on input filename
     output_file = file_list[0][0:-7] + ".npy"
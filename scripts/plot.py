@@ -17,75 +17,93 @@ import matplotlib.colors as colors
 import math
 
 # Other
-import os
 import athena_read
 
 # ---- ---- Data Scaling Methods  ---- ---- #
+# Quadrature rules accepted by the scaling methods
+RULES = ("left", "trapezoid")
+
 """
-Computes the integral of a quantity manually using loops.
-Used for <divergence> wrt phi. rarely used.
+Integrates f along `axis` over the grid x with the chosen rule. 
+"left" is the left Riemann sum, "trapezoid" the trapezoidal rule.
+Argument(s): f: nd array, x: 1d array, axis: int, rule: str
+Returns: f with `axis` integrated out
 """
-def scale_wrt_phi(input_arr, theta): #of format [phi, theta]
-    # Input array validation
-    if input_arr.shape != (256, 256):
+def integrate(f, x, axis, rule="left"):
+    if rule not in RULES:
+        raise ValueError(f"Unknown integration rule {rule}, choose one of {RULES}")
+
+    f = np.moveaxis(f, axis, -1)
+    dx = np.diff(x)
+    if rule == "left":
+        return f[..., :-1] @ dx
+    return 0.5 * (f[..., :-1] @ dx + f[..., 1:] @ dx)
+
+
+"""
+Checks that input_arr is a (batch of) 2d array(s) of format [phi, theta] 
+and that coords is a 1d grid matching its `axis`.
+"""
+def shape_validation(input_arr, coords, axis, name):
+    if input_arr.ndim < 2:
         raise ValueError(f"Input array is not of the correct shape: {input_arr.shape}")
+    if coords.ndim != 1 or len(coords) != input_arr.shape[axis]:
+        raise ValueError(f"{name} array is not of the correct shape: {coords.shape}")
 
-    # theta array validation
-    if theta.shape != (256,):
-        raise ValueError(f"Theta array is not of the correct shape: {theta.shape}")    
 
-    # Integration of theta for each phi
-    yArray = np.zeros(len(input_arr))
+"""
+Computes the integral of a quantity wrt theta for each phi.
+Used for <divergence> wrt phi. rarely used.
+Parameters: input_arr.shape = [..., phi, theta], theta: 1d array
+Optional: rule="left" (left Riemann sum) or "trapezoid"
+Returns: yArray of format [..., phi]
+"""
+def scale_wrt_phi(input_arr, theta, rule="left"): #of format [phi, theta]
+    input_arr = np.asarray(input_arr)
+    theta = np.asarray(theta)
+    shape_validation(input_arr, theta, -1, "Theta")
 
-    for i in range(len(input_arr)):
-      theta_sum = 0.0
-      for j in range(len(input_arr[0]) - 1):
-        d_theta = theta[j+1] - theta[j]
-        theta_sum += (1/2) * input_arr[i][j] * np.sin(theta[j]) * d_theta #left Riemann sum
-        #accurate if data is decreasing
-      yArray[i] = theta_sum
-      #print(yArray[i])
-    return yArray
+    # Integration of theta for each phi
+    return integrate((1/2) * input_arr * np.sin(theta), theta, -1, rule)
 
 
 """
-Computes the integral of a quantity manually using loops.
+Computes the integral of a quantity wrt phi for each theta.
 Used for <divergence> Wrt phi.
-Parameters: input_arr.shape = [phi, theta]
-  int[int []], 2d array
-Returns: yArray: int[] of format [theta]
+Parameters: input_arr.shape = [..., phi, theta], phi: 1d array
+Optional: rule="left" (left Riemann sum) or "trapezoid"
+Returns: yArray of format [..., theta]
 """
-def scale_wrt_theta(input_arr, phi): #of format [phi, theta]
-    # Input array validation
-    if input_arr.shape != (256, 256):
-        raise ValueError(f"Input array is not of the correct shape: {input_arr.shape}")
-    
-    # phi array validation
-    if phi.shape != (256,): 
-        raise ValueError(f"Phi array is not of the correct shape: {phi.shape}")
+def scale_wrt_theta(input_arr, phi, rule="left"): #of format [phi, theta]
+    input_arr = np.asarray(input_arr)
+    phi = np.asarray(phi)
+    shape_validation(input_arr, phi, -2, "Phi")
 
     # Integration of phi for each theta
-    yArray = np.zeros(len(input_arr[0]))
-
-    for i in range(len(input_arr[0])):
-      phi_sum = 0.0
-      for j in range(len(input_arr)-1):
-        d_phi = phi[j+1] - phi[j]
-        phi_sum += (1/(2* math.pi)) * input_arr[j][i] * d_phi
-      yArray[i] = phi_sum
-      #print(yArray[i])
-    return yArray
+    return integrate(input_arr, phi, -2, rule) / (2 * math.pi)
 
 
 # ---- ---- Plotting Method ---- ---- #
 """
 This function takes in a given x and y axis and plots the data.
-Argument(s): xArr: 1d [float], yArr: 1d[float]
-Optional:  xlabel="Theta / pi", ylabel="Dissipation Profile", rad=-1 (sentinel by default)
+Argument(s): xArr: 1d [float], yArr: 1d[float], or 2d [radius, float] for one line per radius
+Optional:  xlabel="Theta / pi", ylabel="Dissipation Profile", rad=-1 (sentinel by default, 
+  or a list of radii labelling the rows of a 2d yArr), yErr=None (same shape as yArr, 
+  shaded as yArr +/- yErr)
 Returns: None
 """
-def plot_data(xArr, yArr, xlabel="Theta / pi", ylabel="Dissipation Profile", title="Dissipation Profile wrt theta", rad=-1):
-    plt.plot(xArr, yArr)
+def plot_data(xArr, yArr, xlabel="Theta / pi", ylabel="Dissipation Profile", title="Dissipation Profile wrt theta", rad=-1, yErr=None):
+    yArr = np.asarray(yArr)
+    if yArr.ndim == 1:
+        plt.plot(xArr, yArr)
+        if yErr is not None:
+            plt.fill_between(xArr, yArr - yErr, yArr + yErr, alpha=0.3)
+    else:
+        for n, y in enumerate(yArr):
+            line, = plt.plot(xArr, y, label=f"radius {rad[n]}")
+            if yErr is not None:
+                plt.fill_between(xArr, y - yErr[n], y + yErr[n], alpha=0.3, color=line.get_color())
+        plt.legend()
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.title(f"{title} generated at radius: {rad}")
@@ -97,29 +115,23 @@ def plot_data(xArr, yArr, xlabel="Theta / pi", ylabel="Dissipation Profile", tit
 # ---- ---- Data Extraction Methods ---- ---- #
 
 """
-Extracts 'theta' data from an .athdf output file and saves it as a NumPy binary file
-for convenient use in graph plotting and further analysis. 
+Reads the 'theta' cell centers of an .athdf output file, for graph plotting
+and further analysis.
 
 Argument(s): file_path (str): full path to the .athdf file
-Returns: None
+Returns: 1D array of theta
 """
-def save_theta(file_path):
-    data = athena_read.athdf(file_path) # reads file
-    theta = data['x2v']
-    path = os.path.join(os.getcwd(), "theta.npy")
-    np.save(path, theta)
-    return None
+def read_theta(file_path):
+    data = athena_read.athdf_grid(file_path) # reads the grid only
+    return data['x2v']
 
 """
-Extracts 'phi' data from an .athdf output file and saves it as a NumPy binary file     
-for convenient use in graph plotting and further analysis.
+Reads the 'phi' cell centers of an .athdf output file, for graph plotting
+and further analysis.
 
 Argument(s): file_path (str): full path to the .athdf file
-Returns: None
+Returns: 1D array of phi
 """
-def save_phi(file_path):
-    data = athena_read.athdf(file_path) # reads file
-    phi = data['x3v']   
-    path = os.path.join(os.getcwd(), "phi.npy")
-    np.save(path, phi)
-    return None
+def read_phi(file_path):
+    data = athena_read.athdf_grid(file_path) # reads the grid only
+    return data['x3v']
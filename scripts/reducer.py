@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""reducer.py
+Streaming reducers used by the controllers to time-average results as they
+arrive from the workers, so memory stays constant in the number of files.
+
+Typical Usage:
+    import reducer
+
+    avg = reducer.RunningMean((256, 256), variance=True)
+    for arr in results:     # any order, one at a time
+        avg.add(arr)
+    avg.mean()
+    avg.variance()
+
+    # Long runs can be checkpointed and resumed
+    reducer.save_checkpoint("run.npz", {"map": avg}, completed_files, radii=radii)
+    reducers, completed_files, meta = reducer.load_checkpoint("run.npz")
+"""
+
+# IMPORTS
+# Helper Module
+import storage
+
+# Other Python Modules
+import numpy as np
+
+
+class RunningMean:
+    """
+    Running sum and count of equally shaped arrays. With variance=True the
+    running variance is kept as well, using Welford's update so that it stays
+    accurate for long runs.
+    """
+    def __init__(self, shape, variance=False):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.total = np.zeros(self.shape, dtype=np.float64)
+        self.track_variance = variance
+        self.m2 = np.zeros(self.shape, dtype=np.float64) if variance else None
+
+    """
+    Folds one array into the running statistics.
+    Argument(s): arr, array of the reducer's shape
+    Returns: None
+    """
+    def add(self, arr):
+        arr = np.asarray(arr, dtype=np.float64)
+        if arr.shape != self.shape:
+            raise ValueError(f"Expected an array of shape {self.shape}, got {arr.shape}")
+
+        if self.track_variance:
+            delta = arr - self.mean() if self.count else arr
+            self.count += 1
+            self.total += arr
+            self.m2 += delta * (arr - self.total / self.count)
+        else:
+            self.count += 1
+            self.total += arr
+        return None
+
+    def mean(self):
+        if self.count == 0:
+            raise ValueError("No arrays to average.")
+        return self.total / self.count
+
+    """
+    Returns the population variance (ddof=0) of the arrays added so far.
+    """
+    def variance(self):
+        if not self.track_variance:
+            raise ValueError("Variance was not tracked, create the reducer with variance=True.")
+        if self.count == 0:
+            raise ValueError("No arrays to average.")
+        return self.m2 / self.count
+
+    """
+    Returns the running statistics as a dict of arrays, see from_state.
+    """
+    def state(self):
+        state = {"count": np.array(self.count), "total": self.total}
+        if self.track_variance:
+            state["m2"] = self.m2
+        return state
+
+    """
+    Rebuilds a reducer from the dict returned by state().
+    """
+    @classmethod
+    def from_state(cls, state):
+        reducer = cls(np.shape(state["total"]), variance="m2" in state)
+        reducer.count = int(state["count"])
+        reducer.total[...] = state["total"]
+        if reducer.track_variance:
+            reducer.m2[...] = state["m2"]
+        return reducer
+
+
+"""
+Writes the reducers, the files already folded into them and any extra 
+metadata to a single .npz file. The file is written next to path and renamed 
+into place, so an interrupted write leaves the previous checkpoint intact.
+Argument(s): path (str), reducers (dict of name: RunningMean), 
+  completed (list of str), metadata as keyword arguments (arrays or strings)
+Returns: None
+"""
+def save_checkpoint(path, reducers, completed, **meta):
+    arrays = {"completed": np.array(list(completed), dtype=str)}
+    for name, reducer in reducers.items():
+        for key, value in reducer.state().items():
+            arrays[f"{name}/{key}"] = value
+    for key, value in meta.items():
+        arrays[f"meta/{key}"] = np.asarray(value)
+
+    storage.atomic_write(path, lambda f: np.savez(f, **arrays))
+    return None
+
+
+"""
+Reads a checkpoint written by save_checkpoint.
+Argument(s): path (str)
+Returns: (dict of name: RunningMean, list of str completed files, dict of metadata)
+"""
+def load_checkpoint(path):
+    states, meta = {}, {}
+    with np.load(path) as data:
+        completed = data["completed"].tolist()
+        for key in data.files:
+            if key.startswith("meta/"):
+                meta[key[len("meta/"):]] = data[key]
+            elif "/" in key:
+                name, field = key.split("/", 1)
+                states.setdefault(name, {})[field] = data[key]
+    reducers = {name: RunningMean.from_state(state) for name, state in states.items()}
+    return reducers, completed, meta
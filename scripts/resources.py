@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""resources.py
+Sizes the controllers' worker pools to the cores and the memory of the
+machine.
+
+One pool process per core runs out of memory on nodes with many cores when
+every file needs a lot of memory, so the pool is sized from an estimate of
+the peak memory of one task (worker.task_bytes, accRate.task_bytes, computed
+from the grid of the files and the variables read) plus the baseline of a
+Python process with the analysis modules imported:
+    workers = min(cores, tasks, usable memory // (task + process))
+The usable memory is a fraction of the memory available to this process,
+taking the cgroup limit of a container or batch job into account, or the
+--max-mem given by the user. --workers overrides the estimate.
+
+Typical Usage:
+    import resources
+
+    parser.add_argument("--max-mem", type=resources.memory_spec)
+    n_workers = resources.pool_size(worker.task_bytes(shape, radii), len(files),
+                                    workers=args.workers, max_mem=args.max_mem)
+"""
+
+# IMPORTS
+import os
+import argparse
+
+# Resident memory of a pool process with numpy, h5py, matplotlib and the
+# analysis modules imported (about 80 MB measured), rounded up
+PROCESS_BYTES = 100 * 2**20
+
+# Share of the available memory the pool may use when no --max-mem is
+# given, leaving room for the controller and the page cache of the reads
+MEMORY_FRACTION = 0.8
+
+UNITS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+"""
+Parses a memory size such as 512M, 64G or 1.5T. A plain number is taken
+as megabytes.
+Returns: int bytes
+"""
+def memory_spec(value):
+    text = value.strip().upper()
+    if text.endswith("B"): # 64GB reads as 64G
+        text = text[:-1]
+    unit = UNITS.get(text[-1:], None)
+    try:
+        size = float(text[:-1] if unit else text) * (unit or UNITS["M"])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid memory size, use e.g. 512M or 64G.")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive memory size.")
+    return int(size)
+
+
+"""
+Reads a cgroup memory file.
+Returns: int, or None if the file is missing or holds no limit ("max")
+"""
+def _read_cgroup(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+"""
+Returns the memory still available to this process in bytes: the
+MemAvailable of the machine, or less if a cgroup limit (container, batch
+job) leaves less. None if it cannot be determined.
+"""
+def available_memory():
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            pass
+
+    # cgroup v2, then v1
+    for limit_file, usage_file in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                                    "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        limit = _read_cgroup(limit_file)
+        usage = _read_cgroup(usage_file)
+        if limit is not None and usage is not None and limit < 2**60: # v1 reports no limit as a huge number
+            left = max(limit - usage, 0)
+            available = left if available is None else min(available, left)
+            break
+    return available
+
+
+"""
+Returns the number of cores this process may run on.
+"""
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS
+        return os.cpu_count() or 1
+
+
+"""
+Chooses the number of pool processes.
+Argument(s): task_bytes (int, estimated peak memory of one task)
+Optional: n_tasks=None (never more processes than tasks), workers=None (use
+  this number, at least 1, skipping the estimate), max_mem=None (bytes the whole pool may
+  use, default: MEMORY_FRACTION of the available memory)
+Returns: int, at least 1
+"""
+def pool_size(task_bytes, n_tasks=None, workers=None, max_mem=None):
+    if workers is not None:
+        if workers < 1:
+            raise ValueError(f"The number of workers must be at least 1, got {workers}.")
+        return workers
+
+    cores = available_cores()
+    memory = max_mem if max_mem else available_memory()
+    n_workers = cores
+    if memory is not None:
+        usable = memory if max_mem else MEMORY_FRACTION * memory
+        n_workers = min(n_workers, int(usable // (task_bytes + PROCESS_BYTES)))
+    if n_tasks is not None:
+        n_workers = min(n_workers, n_tasks)
+    n_workers = max(n_workers, 1)
+
+    memory_text = f"{memory / 2**30:.1f} GB" if memory is not None else "unknown memory"
+    print(f"[INFO] Using {n_workers} workers: {cores} cores, {memory_text}"
+          f"{'' if max_mem else ' available'}, about {task_bytes / 2**20:.0f} MB per file")
+    return n_workers
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""results.py
+On-disk cache of per-file worker results, so re-running an analysis over a
+directory only computes the snapshots that are new or have changed.
+
+Every entry holds the result of one analysis for one file at one radius and
+is addressed by a hash of
+    (absolute file path, file size, file mtime, analysis name, radius, code version)
+where the code version is a hash of the source of the modules that produce
+the result. Touching or rewriting a snapshot, or editing the analysis code,
+changes the key, so stale entries are never reused. Files are identified by
+size and mtime instead of a content hash, since hashing every snapshot would
+cost as much as reading it.
+
+The cache lives in $ATHENA_RESULT_CACHE if set, otherwise in
+$XDG_CACHE_HOME/accretionDiskVisualization/results (~/.cache by default).
+It is kept under a size limit (MAX_BYTES, --cache-size of the controllers)
+by prune(), which drops the least recently used entries first: entries of
+deleted or rewritten snapshots and of older code versions are never loaded
+again, so they go first. Removing the directory clears the cache, e.g.
+    rm -r ~/.cache/accretionDiskVisualization/results
+
+Typical Usage:
+    import results
+
+    cache = results.ResultCache("dissipation", results.code_version(worker, athena_read))
+    keys = cache.keys(file_path, radii)
+    arr = cache.load(keys)           # None unless every radius is cached
+    if arr is None:
+        arr = compute(file_path, radii)
+        cache.save(keys, arr)
+    results.prune(max_bytes=args.cache_size)
+"""
+
+# IMPORTS
+import os
+import time
+import hashlib
+
+# Helper Module
+import storage
+
+# Other Python Modules
+import numpy as np
+
+# Default size limit of the whole result cache, every analysis included
+MAX_BYTES = 2 * 2**30
+
+
+"""
+Returns the directory holding the result cache.
+"""
+def cache_dir():
+    return storage.cache_path("results", "ATHENA_RESULT_CACHE")
+
+
+"""
+Hashes the source files of the given modules, so cached results are dropped
+whenever the code producing them changes.
+Argument(s): modules
+Returns: str, hex digest
+"""
+def code_version(*modules):
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Per-file, per-radius results of one analysis, stored as .npy files under
+    cache_dir()/<analysis>/.
+    """
+    def __init__(self, analysis, version, root=None):
+        self.analysis = analysis
+        self.version = version
+        self.root = os.path.join(root or cache_dir(), analysis)
+
+    """
+    Builds the cache keys of one file, one per radius. The file is stat'ed
+    here, so take the keys before computing the result: a file rewritten in
+    the meantime is then stored under its old key and recomputed next time.
+    Argument(s): file_path (str), radii (int or list of int)
+    Returns: list of str
+    """
+    def keys(self, file_path, radii):
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        keys = []
+        for radius in np.atleast_1d(radii):
+            ident = f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}|{self.analysis}|{int(radius)}|{self.version}"
+            keys.append(hashlib.sha256(ident.encode()).hexdigest())
+        return keys
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    """
+    Loads the cached results for keys.
+    Argument(s): keys (list of str)
+    Returns: array of format [radius, ...], or None if any key is missing
+    """
+    def load(self, keys):
+        entries = []
+        for key in keys:
+            try:
+                entries.append(np.load(self.path(key)))
+            except (OSError, ValueError): # missing or partially written
+                return None
+        for key in keys: # mark the entries as used, for prune
+            try:
+                os.utime(self.path(key))
+            except OSError: # removed by a concurrent prune, it is loaded already
+                pass
+        return np.stack(entries)
+
+    """
+    Stores one result per key. Entries are written to a temporary file and
+    renamed into place, so readers never see a partial entry.
+    Argument(s): keys (list of str), arr (array of format [radius, ...])
+    Returns: None
+    """
+    def save(self, keys, arr):
+        arr = np.asarray(arr)
+        if len(keys) != len(arr):
+            raise ValueError(f"Got {len(arr)} results for {len(keys)} keys.")
+        for key, entry in zip(keys, arr):
+            storage.atomic_write(self.path(key), lambda f: np.save(f, entry))
+        return None
+
+
+"""
+Removes the least recently used entries (by mtime, which load() refreshes)
+until the whole cache, every analysis included, fits in max_bytes. Left-over
+temporary files of interrupted writes are removed as well.
+Optional: max_bytes=MAX_BYTES, root=None (default: cache_dir())
+Returns: int, number of bytes removed
+"""
+def prune(max_bytes=MAX_BYTES, root=None):
+    entries = []
+    removed = 0
+    for dirpath, _, filenames in os.walk(root or cache_dir()):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError: # removed in the meantime
+                continue
+            if name.startswith(".tmp-"):
+                if stat.st_mtime < time.time() - 3600: # not a write in progress
+                    os.remove(path)
+                    removed += stat.st_size
+            elif name.endswith(".npy"):
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError: # removed by another process
+            pass
+        total -= size
+        removed += size
+    return removed
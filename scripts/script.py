@@ -28,13 +28,18 @@ import argparse # CLI parsing
 import subprocess # run external commands
 
 # Multiprocessing libraries: 
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Custom Helper Modules
 import worker
+import geometry
+import instrument
 import plot
-import timer
+import reducer
+import resources
+import results
+import shared
+import snapshots
 
 # Other Python modules
 import numpy as np
@@ -67,6 +72,25 @@ def radial_int(value):
         raise ValueError(f"{fvalue} is out of bounds. Radius must be between -{len_r} and {len_r -1}.") 
     return fvalue
 
+"""
+Parses one radius argument: either a single index ("300") or a range 
+written start:stop[:step] ("100:200:10", stop excluded).
+Returns: list of int radial indices
+"""
+def radial_spec(value): 
+    if ":" not in value:
+        return [radial_int(value)]
+
+    parts = value.split(":")
+    if len(parts) > 3:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid range, use start:stop[:step].")
+    start, stop = radial_int(parts[0]), radial_int(parts[1])
+    step = int(parts[2]) if len(parts) == 3 and parts[2] else 1
+    radii = list(range(start, stop, step))
+    if not radii:
+        raise argparse.ArgumentTypeError(f"{value} is an empty range.")
+    return radii
+
 """
 This function recursively walks upward from the file location to find the project root. 
 marker_name can be a directory like ".git" or a file (".yml")
@@ -91,74 +115,213 @@ def find_proj_root(marker_name):
 
 
 # ==== ==== Core Worker ===== ===== #
-def run_worker_script(file_path, radius):
+"""
+Runs worker.run_program directly inside a pool process. The pool processes are 
+long-lived, so the interpreter start-up and module imports are paid once per 
+process instead of once per file. The result is written into slot `index` of 
+the controller's shared buffer.
+Argument(s): index (int), file_path (str), radius (int or list of int), shm_name (str)
+Optional: profile_dir=None (dump a cProfile of the file there), 
+  max_bytes=None (memory budget of the divergence, see worker.chunked_divergence), 
+  float32=False (compute in float32, see worker.divergence)
+Returns: (True if the result was written, False if the file could not be processed, 
+  list of the timing records of the file)
+"""
+def run_worker(index, file_path, radius, shm_name, profile_dir=None, max_bytes=None, float32=False):
+    # Use absolute paths so worker processes can find external hard drives
+    file_path = os.path.abspath(file_path) # path of athdf file
+
+    ok = True
+    with instrument.profiled(profile_dir, os.path.basename(file_path)), instrument.task(file_path):
+        try: 
+            result = worker.run_program(file_path, radius, max_bytes=max_bytes, float32=float32)
+            with instrument.span("ipc"):
+                shared.write_result(shm_name, index, result)
+        except Exception as e: 
+            print(f"Error: worker.run_program failed on {file_path}: {e}")
+            ok = False
+    return ok, instrument.drain()
+
+
+"""
+Runs worker.py as a separate Python process for one file, for debugging or when 
+each file must be isolated from the others. The worker writes its result into 
+slot `index` of the controller's shared buffer. Only the whole run of the 
+process is timed, and profile_dir is not used.
+Returns: (bool, list of the timing records of the file), as run_worker
+"""
+def run_worker_script(index, file_path, radius, shm_name, profile_dir=None, max_bytes=None, float32=False):
     # Use absolute paths so worker processes can find external hard drives
     file_path = os.path.abspath(file_path) # path of athdf file
-    
-    # Create output filename based on input filename
-    output_file = file_path + ".npy"
 
     project_root = find_proj_root('.git')
     # Debugging: print(f"Root: {project_root}")
     worker_path = os.path.join(project_root, 'scripts', 'worker.py')
 
-    result = subprocess.run(
-        [sys.executable, worker_path, str(radius), file_path, output_file],
-        capture_output=True, text=True
-    )
+    command = [sys.executable, worker_path, ",".join(map(str, np.atleast_1d(radius))), file_path, "--shm", shm_name, str(index)]
+    if max_bytes is not None:
+        command += ["--max-bytes", str(max_bytes)]
+    if float32:
+        command.append("--float32")
+    with instrument.task(file_path):
+        result = subprocess.run(command, capture_output=True, text=True)
     
     # Check if worker.py succeeded
     if result.returncode != 0: 
         print(f"Error: worker.py failed on {file_path}:\n{result.stderr}") 
-        return None
+        return False, instrument.drain()
 
-    # Load the .npy result
-    try: 
-        arr = np.load(output_file)
-    except Exception as e: 
-        print(f"Error: failed to load {output_file}: {e}")
-        return None   
+    return True, instrument.drain()
 
-    # Delete the .npy file when no longer needed 
-    os.remove(output_file)
 
-    return arr 
+"""
+Runs worker_fn over file_list in a process pool and yields (index, result) 
+pairs in completion order. Results come back through a shared buffer with a 
+fixed number of slots; a slot is only reused once the caller has consumed the 
+previous result in it, so memory does not grow with the number of files. The 
+yielded array is only valid until the next iteration.
+Argument(s): worker_fn, file_list, result_shape (tuple), keyword arguments for worker_fn
+Optional: n_workers=None (one per core), report=None (instrument.Report 
+  collecting the timing records of the workers)
+Yields: (int, np.ndarray or None if the file failed)
+"""
+def stream_results(worker_fn, file_list, result_shape, n_workers=None, report=None, **kwargs):
+    n_workers = n_workers or os.cpu_count() or 1
+    n_slots = max(min(len(file_list), 2 * n_workers), 1)
+
+    shm, buffer = shared.create_buffer((n_slots,) + tuple(result_shape))
+    try: 
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            free_slots = list(range(n_slots))
+            pending = {}
+            next_file = 0
+
+            while pending or next_file < len(file_list):
+                # Keep every free slot busy
+                while free_slots and next_file < len(file_list):
+                    slot = free_slots.pop()
+                    future = executor.submit(worker_fn, slot, file_list[next_file], 
+                                             shm_name=shm.name, **kwargs)
+                    pending[future] = (next_file, slot)
+                    next_file += 1
+
+                # Hand back the first finished result, then free its slot
+                future = next(as_completed(pending))
+                i, slot = pending.pop(future)
+                ok, records = future.result()
+                if report is not None:
+                    report.add(records)
+                yield i, (buffer[slot] if ok else None)
+                free_slots.append(slot)
+    finally: 
+        del buffer # release the view so the block can be closed
+        shared.release(shm)
 
 
 # ==== ==== THE MAIN FUNCTION ==== ==== #
 def main():
     # Positional Arguments
-    parser = argparse.ArgumentParser(description="Usage: python(3) script.py <radius>")
-    parser.add_argument("radius", type=radial_int, help="Integer radius index between -512 and 511.")
+    parser = argparse.ArgumentParser(description="Usage: python(3) script.py <radius> [<radius> ...]")
+    parser.add_argument("radius", type=radial_spec, nargs="+", 
+    help="Integer radius index between -512 and 511, or a range start:stop[:step]. Several may be given.")
     
     # Optional Arguments    
     parser.add_argument("-t", "--time", 
     action="store_true",
     dest="time_measured",
-    help="Option to measure and display time of program.")
+    help="Show the time spent per stage (read, divergence, reduction, ...) over all workers. "
+         "The plot stage includes the time the plot window is open.")
+
+    parser.add_argument("--report", 
+    metavar="PATH",
+    help="Save the per-stage timings and the raw timing records to PATH (.json).")
+
+    parser.add_argument("--profile", 
+    metavar="DIR",
+    help="Dump cProfile statistics of the controller and of every file processed in the pool to DIR.")
     
     parser.add_argument("-d", "--dir", default=".", help='Path to the drectory contianing the .athdf files (default: current directory)')    
 
+    snapshots.add_arguments(parser)
+
+    parser.add_argument("--rule", choices=plot.RULES, default="left",
+    help="Quadrature rule used to integrate over phi (default: left Riemann sum).")
+
+    parser.add_argument("--std", 
+    action="store_true",
+    help="Also show the spread (standard deviation over time) of the dissipation profile.")
+
+    parser.add_argument("--subprocess", 
+    action="store_true",
+    dest="use_subprocess",
+    help="Run worker.py as a new Python process for every file instead of inside the worker pool.")
+
+    parser.add_argument("--workers", 
+    type=snapshots.positive_int, metavar="N",
+    help="Number of worker processes (default: as many as the cores and --max-mem allow).")
+
+    parser.add_argument("--max-mem", 
+    type=resources.memory_spec, metavar="SIZE",
+    help="Memory all workers together may use, e.g. 200G, used to size the pool "
+         "(default: 80%% of the available memory).")
+
+    parser.add_argument("--worker-mem", 
+    type=resources.memory_spec, metavar="SIZE",
+    help="Cap the memory of each worker's divergence at about SIZE, e.g. 2G (plain numbers are MB), "
+         "by processing every file in phi slabs (default: the whole radial window at once).")
+
+    parser.add_argument("--float32", 
+    action="store_true",
+    help="Compute the divergence in float32, the precision of the files, instead of float64. "
+         "Faster and half the memory; see worker.divergence for the error bound.")
+
+    parser.add_argument("--checkpoint", 
+    metavar="PATH",
+    help="Periodically save the running average and the finished files to PATH (.npz).")
+
+    parser.add_argument("--checkpoint-every", 
+    type=snapshots.positive_int, default=10, metavar="N",
+    help="Number of finished files between checkpoints (default: 10).")
+
+    parser.add_argument("--resume", 
+    action="store_true",
+    help="Continue from the --checkpoint file of an interrupted run, skipping the files it already holds.")
+
+    parser.add_argument("--no-cache", 
+    action="store_true",
+    dest="no_cache",
+    help="Recompute every file instead of reusing results cached by earlier runs.")
+
+    parser.add_argument("--cache-size", 
+    type=resources.memory_spec, default=results.MAX_BYTES, metavar="SIZE",
+    dest="cache_size",
+    help="Size limit of the result cache, e.g. 500M or 10G; the least recently used "
+         "results are removed first (default: 2G).")
+
     args = parser.parse_args()
+    radii = [rad for spec in args.radius for rad in spec] # flatten ranges
+    max_bytes = args.worker_mem
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint PATH")
+
+    # Timing records of the controller and the workers
+    instrument.enable()
+    report = instrument.Report()
+    profiler = instrument.start_profile() if args.profile else None
     
     # Can manually specify files here
     # file_list = ["disk.out1.00018.athdf", "disk.out1.00019.athdf"]
-    
-    """
-    # TODO: add --start, -s and --end, -e and --inc, -i flags
-    os.path.exists(filename)
-
-    specify range for customization
-    - assumes filenames follow strict pattern
-    - selective filtering of athdf files
-    """
 
     # ---- ---- Find the files to process ---- ---- #
-    data_dir = os.path.abspath(args.dir) # Normalizing the path
-    file_list = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith(".athdf")]
+    # Snapshot order, narrowed down by -s/-e/-i and --t-min/--t-max. The 
+    # index keeps the headers of earlier runs, so only new files are opened.
+    with instrument.span("scan"):
+        index = snapshots.scan(args.dir)
+        file_list = snapshots.select_from_args(list(index), args, index)
+        file_list = snapshots.validate(file_list, index, quantities=worker.QUANTITIES)
 
     if not file_list: # file list is empty
-        print(f"There are no .athdf files detected in directory: {args.dir}")
+        print(f"There are no selected .athdf files in directory: {args.dir}")
         return # Should stop the program, since nohing to compute
 
     # Debugging which files used.
@@ -166,80 +329,138 @@ def main():
     first_f = file_list[0] # fastest
     print(first_f)
 
-    if args.time_measured:
-        t = timer.Timer()
-        t.start_time()
-
-    worker_fn = partial(run_worker_script, radius=args.radius)
-
-    # If doesn't exist, save theta and phi arrays for later
-    theta_path = os.path.abspath("theta.npy")
-    phi_path = os.path.abspath("phi.npy")
-    
-    if (not os.path.exists(theta_path)):
-        plot.save_theta(first_f)
-    if (not os.path.exists(phi_path)):
-        plot.save_phi(first_f)
-
-    # Create output filename based on input filename
-    output_file = file_list[0][0:-7] + ".npy"
-
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(worker_fn, file_list))
-        
-    # TODO: don't keep this debug, but write a check to ensure correct type
-    # Debugging: 
-    for i, r in enumerate(results):
-        if r is None:
-            print(f"[DEBUG] results[{i}] is None")
-        elif not isinstance(r, np.ndarray):
-            print(f"[DEBUG] results[{i}] is NOT a NumPy array: {type(r)}")
-        elif r.shape != (256, 256):
-            print(f"[DEBUG] results[{i}] has shape {r.shape}")
-        elif r.dtype == object:
-            print(f"[DEBUG] results[{i}] has dtype=object")
-    
-    
-    # Ensure arrays are 2d and numeric
-    valid_arrs = [
-        np.asarray(arr, dtype=np.float64)
-        for arr in results
-        if arr is not None and isinstance(arr, np.ndarray) and arr.shape == (256, 256)
-    ]
+    if args.use_subprocess:
+        worker_fn = run_worker_script
+    else:
+        worker_fn = run_worker
 
-    if not valid_arrs: # if empty 
-        raise ValueError("No valid 256x256 arrays to average.")
-
-    avg = np.zeros((256, 256), dtype=np.float64)
-    for arr in valid_arrs:
-        avg += arr
-
-    avg /= len(valid_arrs)
-    
-    loading = "./theta.npy"
+    # Load the grid from the geometry cache, building it once for the workers
     try: 
-        theta = np.load(loading)
-        loading = "./phi.npy"
-        phi = np.load(loading)
+        with instrument.span("geometry"):
+            geom = geometry.load(first_f)
+        theta = np.asarray(geom['theta'])
+        phi = np.asarray(geom['phi'])
     except Exception as e: 
-        print(f"Error: failed to load {loading}: {e}")
+        print(f"Error: failed to load the geometry of {first_f}: {e}")
         return None 
+
+    # Fold results into a running mean as they complete. 
+    # Every file gives one [phi, theta] map per radius.
+    shape = (len(radii), len(phi), len(theta))
+    avg_map = reducer.RunningMean(shape)
+    if args.std:
+        avg_profile = reducer.RunningMean((len(radii), len(theta)), variance=True)
+
+    # Settings a checkpoint must share with this run to be resumed, with the 
+    # names they are reported under
+    run_meta = {"radii": radii, "rule": args.rule, "std": args.std, "float32": args.float32,
+                "dir": os.path.abspath(args.dir), "grid": index[first_f]["grid"], "files": file_list}
+    meta_names = {"radii": "radii", "rule": "--rule", "std": "--std", "float32": "--float32",
+                  "dir": "data directory (-d)", "grid": "grid", "files": "snapshot selection"}
+
+    # Pick up the running average of an interrupted run
+    completed = []
+    if args.resume and os.path.exists(args.checkpoint):
+        try: 
+            reducers, completed, meta = reducer.load_checkpoint(args.checkpoint)
+            differing = [meta_names[key] for key, value in run_meta.items()
+                         if key not in meta or meta[key].tolist() != value]
+            if differing:
+                raise ValueError(f"it was written with a different {', '.join(differing)}. "
+                                 "Start a new run without --resume, or use another --checkpoint path")
+            avg_map = reducers["map"]
+            if args.std:
+                avg_profile = reducers["profile"]
+        except Exception as e: 
+            print(f"Error: cannot resume from {args.checkpoint}: {e}")
+            return None
+        print(f"Resuming from {args.checkpoint}, {len(completed)} files already done")
+    done = set(completed)
+    file_list = [f for f in file_list if f not in done]
+
+    def checkpoint():
+        reducers = {"map": avg_map}
+        if args.std:
+            reducers["profile"] = avg_profile
+        reducer.save_checkpoint(args.checkpoint, reducers, completed, **run_meta)
+
+    def fold(f, arr):
+        with instrument.span("reduction"):
+            avg_map.add(arr)
+            if args.std:
+                avg_profile.add(plot.scale_wrt_theta(arr, phi, rule=args.rule))
+        completed.append(f)
+        if args.checkpoint and len(completed) % args.checkpoint_every == 0:
+            checkpoint()
+
+    # Results of earlier runs are folded in straight from the cache, only 
+    # new or changed files go to the workers
+    todo = file_list
+    if not args.no_cache:
+        cache = results.ResultCache("dissipation-float32" if args.float32 else "dissipation", results.code_version(worker, worker.athena_read, geometry))
+        todo, todo_keys = [], []
+        for f in file_list:
+            with instrument.span("cache"):
+                keys = cache.keys(f, radii)
+                arr = cache.load(keys)
+            if arr is None:
+                todo.append(f)
+                todo_keys.append(keys)
+            else:
+                fold(f, arr)
+        print(f"{len(file_list) - len(todo)} of {len(file_list)} files taken from the result cache")
+
+    if todo:
+        # As many workers as the cores and the memory allow
+        task_bytes = worker.task_bytes(geometry.grid_shape(geom), radii, max_bytes=max_bytes, float32=args.float32)
+        if args.use_subprocess: # every file runs in a new interpreter besides the pool process
+            task_bytes += resources.PROCESS_BYTES
+        n_workers = resources.pool_size(task_bytes, len(todo), workers=args.workers, max_mem=args.max_mem)
+
+        for i, arr in stream_results(worker_fn, todo, shape, n_workers=n_workers, report=report, radius=radii, 
+                                     profile_dir=args.profile, max_bytes=max_bytes, 
+                                     float32=args.float32):
+            if arr is None:
+                print(f"[DEBUG] {todo[i]} failed, leaving it out of the average")
+                continue
+            if not args.no_cache:
+                cache.save(todo_keys[i], arr)
+            fold(todo[i], arr)
+
+    if not args.no_cache:
+        results.prune(max_bytes=args.cache_size)
+
+    if args.checkpoint:
+        checkpoint()
+
+    avg = avg_map.mean()
     
     
-    # Scale the yaxis data from (256, 256) to (256)
-    yArr = plot.scale_wrt_theta(avg, phi) # final y array
+    # Scale the yaxis data from (radius, 256, 256) to (radius, 256)
+    yArr = plot.scale_wrt_theta(avg, phi, rule=args.rule) # final y arrays
 
     # Define x array
     xArr = (theta / np.pi) 
 
-    if args.time_measured:
-        t.end_time()
-
-    plot.plot_data(xArr, yArr, rad=args.radius)	
+    # A single radius keeps the original one-line plot
+    rad = radii if len(radii) > 1 else radii[0]
+    if len(radii) == 1:
+        yArr = yArr[0]
+    with instrument.span("plot"):
+        if args.std:
+            yErr = np.sqrt(avg_profile.variance())
+            plot.plot_data(xArr, yArr, rad=rad, yErr=yErr if len(radii) > 1 else yErr[0])
+        else:
+            plot.plot_data(xArr, yArr, rad=rad)	
 
     print("Program executed successfully!")
+    if profiler is not None:
+        instrument.stop_profile(profiler, os.path.join(args.profile, "controller.prof"))
+    report.add(instrument.drain())
     if args.time_measured:
-        t.getTotalTime()
+        report.show()
+    if args.report:
+        report.save(args.report)
 
 	
 if __name__ == "__main__":
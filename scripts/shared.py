@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""shared.py
+Shared-memory result buffers used to hand worker results back to the
+controller without writing intermediate files.
+
+The controller owns one buffer holding a slot per task. Each worker attaches
+to the buffer by name and writes its result into its slot; nothing touches disk.
+The slot shape and dtype are stored in a small header at the start of the
+block, so a worker cannot write a result of the wrong shape over its
+neighbours' slots, even when it was started with only the buffer's name.
+
+Typical Usage:
+    import shared
+
+    shm, buffer = shared.create_buffer((n_files, 256, 256))   # controller
+    shared.write_result(shm.name, index, result)              # worker
+    ...
+    shared.release(shm)                                       # controller
+"""
+
+# IMPORTS
+import json
+from multiprocessing import shared_memory, resource_tracker
+
+# Other Python Modules
+import numpy as np
+
+# Bytes at the start of a block holding the slot shape and dtype (JSON),
+# a multiple of 64 so the slots stay aligned
+HEADER_BYTES = 256
+
+
+"""
+Creates a zero-filled shared memory block and a NumPy array backed by it.
+The first dimension counts the slots, the rest is the shape of one slot.
+Argument(s): shape (tuple), optional dtype (default float64)
+Returns: (SharedMemory, np.ndarray)
+"""
+def create_buffer(shape, dtype=np.float64):
+    dtype = np.dtype(dtype)
+    header = json.dumps({"slot_shape": list(shape[1:]), "dtype": dtype.str}).encode()
+    if len(header) > HEADER_BYTES:
+        raise ValueError(f"Slot shape {tuple(shape[1:])} does not fit in the buffer header.")
+    nbytes = HEADER_BYTES + int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    shm.buf[:len(header)] = header
+    shm.buf[len(header):HEADER_BYTES] = b" " * (HEADER_BYTES - len(header))
+    buffer = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=HEADER_BYTES)
+    buffer.fill(0)
+    return shm, buffer
+
+
+"""
+Writes one result into slot `index` of the buffer called `name`. The result
+is converted to the buffer's dtype and must have its slot shape.
+Set untrack=True when the caller is not a child of the controller (e.g. a
+worker started with subprocess), so that its own resource tracker does not
+remove the buffer when it exits.
+Argument(s): name (str), index (int), result (array or scalar)
+Optional: untrack=False
+Returns: None
+Raises: ValueError if the result does not have the slot shape, IndexError
+  if the buffer has no slot `index`
+"""
+def write_result(name, index, result, untrack=False):
+    shm = shared_memory.SharedMemory(name=name)
+    if untrack:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        header = json.loads(bytes(shm.buf[:HEADER_BYTES]))
+        slot_shape, dtype = tuple(header["slot_shape"]), np.dtype(header["dtype"])
+        result = np.asarray(result, dtype=dtype)
+        if result.shape != slot_shape:
+            raise ValueError(f"Result of shape {result.shape} does not fit the slots of "
+                             f"shared buffer {name}, of shape {slot_shape}.")
+        slot_bytes = int(np.prod(slot_shape)) * dtype.itemsize
+        offset = HEADER_BYTES + index * slot_bytes
+        if index < 0 or offset + slot_bytes > shm.size:
+            raise IndexError(f"Slot {index} is outside of shared buffer {name}.")
+        slot = np.ndarray(slot_shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        slot[...] = result
+        del slot # release the view so the block can be closed
+    finally:
+        shm.close()
+    return None
+
+
+"""
+Closes and removes a buffer made by create_buffer. Any arrays viewing the
+buffer must be deleted first.
+Argument(s): shm (SharedMemory)
+Returns: None
+"""
+def release(shm):
+    shm.close()
+    shm.unlink()
+    return None
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""snapshots.py
+Finds the .athdf snapshots of a run and selects a subset of them, shared by
+the controllers.
+
+Snapshots are named <problem>.<output>.NNNNN.athdf (e.g. disk.out1.00042.athdf).
+The number is parsed once and used to sort the files in natural order and to
+select a range. The simulation time window is checked against the Time
+attribute of each file, which only needs a header read.
+
+Typical Usage:
+    import snapshots
+
+    file_list = snapshots.find_snapshots("data/")
+    file_list = snapshots.select(file_list, start=100, end=200, stride=5, t_min=50.0)
+
+    # Controllers: -s/--start, -e/--end, -i/--inc, --t-min, --t-max
+    snapshots.add_arguments(parser)
+    index = snapshots.scan(args.dir)
+    file_list = snapshots.select_from_args(list(index), args, index)
+    file_list = snapshots.validate(file_list, index, quantities=("Fr1", "Fr2", "Fr3"))
+
+Snapshot index:
+scan() keeps an index of every snapshot of a directory (number, size,
+mtime, Time, cycle, grid hash, variable names), so that selecting and
+validating files does not open them again. It is built with os.scandir and
+header-only reads, and updated incrementally: only files that are new or
+whose size or mtime changed are opened, and files whose read failed are
+tried again by the next scans, up to READ_ATTEMPTS times. The index is a
+JSON file in
+$ATHENA_SNAPSHOT_INDEX if set, otherwise in
+$XDG_CACHE_HOME/accretionDiskVisualization/index (~/.cache by default),
+named after a hash of the directory path.
+"""
+
+# IMPORTS
+import os
+import re
+import json
+import argparse
+import hashlib
+
+# Helper Module
+import geometry
+import storage
+
+# Other Python Modules
+import h5py
+
+SNAPSHOT_PATTERN = re.compile(r"\.(\d+)\.athdf$")
+
+# Bump when the index entries change, so old indexes are rebuilt
+INDEX_VERSION = 3
+
+# Scans that open a file whose read failed (OSError) before it is left
+# alone until its size or mtime changes
+READ_ATTEMPTS = 3
+
+
+"""
+Parses the snapshot number of an .athdf file name.
+Argument(s): file_path (str)
+Returns: int, or None if the name does not end in .NNNNN.athdf
+"""
+def snapshot_number(file_path):
+    match = SNAPSHOT_PATTERN.search(os.path.basename(file_path))
+    return int(match.group(1)) if match else None
+
+
+"""
+Reads the simulation time of a snapshot from its header.
+Argument(s): file_path (str)
+Returns: float
+"""
+def snapshot_time(file_path):
+    with h5py.File(file_path, "r") as f:
+        return float(f.attrs["Time"])
+
+
+"""
+Orders files by snapshot number. Files without a number go last, by name.
+Argument(s): file_list (list of str)
+Returns: sorted list of str
+"""
+def sort_snapshots(file_list):
+    def order(f):
+        number = snapshot_number(f)
+        return (number is None, number if number is not None else 0, os.path.basename(f))
+    return sorted(file_list, key=order)
+
+
+"""
+Lists the .athdf files of a directory in snapshot order.
+Argument(s): directory (str)
+Returns: list of absolute paths
+"""
+def find_snapshots(directory):
+    directory = os.path.abspath(directory)
+    return sort_snapshots([os.path.join(directory, f) for f in os.listdir(directory)
+                           if f.endswith(".athdf")])
+
+
+"""
+Selects snapshots by number and by simulation time. The number range is
+inclusive, and files without a number are dropped when a range is given.
+The time window is inclusive as well and reads the header of every file
+that passed the number range; files whose header cannot be read are
+dropped. stride then keeps every stride-th of the remaining files, so gaps
+in the numbering do not shift the sampling.
+Argument(s): file_list (list of str, in snapshot order)
+Optional: start=None, end=None (snapshot numbers), stride=1,
+  t_min=None, t_max=None (simulation time),
+  index=None (from scan, times are then taken from it instead of the headers)
+Returns: list of str
+"""
+def select(file_list, start=None, end=None, stride=1, t_min=None, t_max=None, index=None):
+    if stride < 1:
+        raise ValueError(f"Stride must be a positive integer, got {stride}.")
+
+    if start is not None or end is not None:
+        numbered = [(f, snapshot_number(f)) for f in file_list]
+        file_list = [f for f, n in numbered if n is not None
+                     and (start is None or n >= start) and (end is None or n <= end)]
+
+    if t_min is not None or t_max is not None:
+        in_window = []
+        for f in file_list:
+            try:
+                t = index[f]["time"] if index is not None else snapshot_time(f)
+                if t is None:
+                    raise OSError(index[f]["error"])
+            except (OSError, KeyError) as e: # unreadable header, the workers would fail too
+                print(f"[DEBUG] Skipping {f}, cannot read its time: {e}")
+                continue
+            if (t_min is None or t >= t_min) and (t_max is None or t <= t_max):
+                in_window.append(f)
+        file_list = in_window
+
+    return file_list[::stride]
+
+
+"""
+Parses a positive integer argument, such as the stride or a number of workers.
+"""
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid integer.")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} must be a positive integer.")
+    return number
+
+
+"""
+Parses a snapshot number argument, a non-negative integer.
+"""
+def snapshot_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid snapshot number.")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid snapshot number, numbers start at 0.")
+    return number
+
+
+"""
+Adds the snapshot selection options to a controller's argument parser.
+Argument(s): parser (argparse.ArgumentParser)
+Returns: None
+"""
+def add_arguments(parser):
+    parser.add_argument("-s", "--start", type=snapshot_int, 
+    help="First snapshot number to process (default: the first one).")
+
+    parser.add_argument("-e", "--end", type=snapshot_int, 
+    help="Last snapshot number to process, included (default: the last one).")
+
+    parser.add_argument("-i", "--inc", type=positive_int, default=1, 
+    help="Process every inc-th selected snapshot (default: 1).")
+
+    parser.add_argument("--t-min", type=float, dest="t_min", 
+    help="Skip snapshots with simulation time below T_MIN.")
+
+    parser.add_argument("--t-max", type=float, dest="t_max", 
+    help="Skip snapshots with simulation time above T_MAX.")
+    return None
+
+
+"""
+Applies the options added by add_arguments.
+Argument(s): file_list (list of str, in snapshot order), args (argparse.Namespace)
+Returns: list of str
+"""
+def select_from_args(file_list, args, index=None):
+    return select(file_list, start=args.start, end=args.end, stride=args.inc,
+                  t_min=args.t_min, t_max=args.t_max, index=index)
+
+
+# ---- ---- Snapshot Index ---- ---- #
+
+"""
+Returns the directory holding the snapshot indexes.
+"""
+def index_dir():
+    return storage.cache_path("index", "ATHENA_SNAPSHOT_INDEX")
+
+
+"""
+Returns the path of the index file of a data directory.
+"""
+def index_path(directory):
+    directory = os.path.abspath(directory)
+    name = hashlib.sha256(directory.encode()).hexdigest()[:16]
+    return os.path.join(index_dir(), name + ".json")
+
+
+"""
+Reads the header of one snapshot. Files whose header cannot be read get an
+entry too, with the error message and no time. A malformed header (missing
+attributes) is not opened again until the file changes. A failed read
+(OSError) may be transient, e.g. a flaky network or external drive, so its
+entry is marked "retry" and counts the failed "attempts"; scan opens the
+file again until READ_ATTEMPTS is reached.
+Argument(s): file_path (str), size, mtime_ns (int, from the directory scan)
+Returns: dict
+"""
+def read_header(file_path, size, mtime_ns):
+    entry = {"number": snapshot_number(file_path), "size": size, "mtime_ns": mtime_ns,
+             "time": None, "cycle": None, "grid": None, "variables": [], "error": None,
+             "retry": False, "attempts": 0}
+    try:
+        with h5py.File(file_path, "r") as f:
+            entry["time"] = float(f.attrs["Time"])
+            entry["cycle"] = int(f.attrs["NumCycles"])
+            entry["grid"] = geometry.grid_key_from_attrs(f.attrs)
+            entry["variables"] = [name.decode("ascii", "replace") for name in f.attrs["VariableNames"]]
+    except KeyError as e:
+        entry["error"] = str(e)
+    except OSError as e:
+        entry["error"] = str(e)
+        entry["retry"] = True
+        entry["attempts"] = 1
+    return entry
+
+
+"""
+Indexes the .athdf files of a directory, reusing the stored index for files
+whose size and mtime did not change, except failed reads with attempts
+left. The updated index is written back atomically when anything changed.
+Argument(s): directory (str)
+Returns: dict of absolute path: entry, in snapshot order
+"""
+def scan(directory):
+    directory = os.path.abspath(directory)
+    path = index_path(directory)
+
+    stored = {}
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get("version") == INDEX_VERSION and saved.get("directory") == directory:
+            stored = saved["files"]
+    except (OSError, ValueError): # no index yet, or an unreadable one
+        pass
+
+    files = {}
+    changed = False
+    with os.scandir(directory) as it:
+        for dir_entry in it:
+            if not dir_entry.name.endswith(".athdf") or not dir_entry.is_file():
+                continue
+            stat = dir_entry.stat()
+            entry = stored.get(dir_entry.name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                entry = read_header(dir_entry.path, stat.st_size, stat.st_mtime_ns)
+                changed = True
+            elif entry["retry"] and entry["attempts"] < READ_ATTEMPTS: # the read failed, try again
+                attempts = entry["attempts"]
+                entry = read_header(dir_entry.path, stat.st_size, stat.st_mtime_ns)
+                if entry["retry"]:
+                    entry["attempts"] += attempts
+                changed = True
+            files[dir_entry.name] = entry
+    changed = changed or len(files) != len(stored)
+
+    if changed:
+        storage.atomic_write(path, lambda f: json.dump({"version": INDEX_VERSION, "directory": directory,
+                                                        "files": files}, f), mode="w")
+
+    return {os.path.join(directory, name): files[name]
+            for name in sort_snapshots(list(files))}
+
+
+"""
+Drops the files that cannot be averaged with the first one: files with an
+unreadable header, on a different grid, or missing one of the quantities.
+Only the index is used, no file is opened.
+Argument(s): file_list (list of str), index (from scan)
+Optional: quantities=() (variable names every file must hold)
+Returns: list of str
+"""
+def validate(file_list, index, quantities=()):
+    valid = []
+    grid = None
+    for f in file_list:
+        entry = index[f]
+        if entry["error"] is not None:
+            print(f"[DEBUG] Skipping {f}, cannot read its header: {entry['error']}")
+            continue
+        missing = [q for q in quantities if q not in entry["variables"]]
+        if missing:
+            print(f"[DEBUG] Skipping {f}, it has no {', '.join(missing)}")
+            continue
+        grid = grid or entry["grid"]
+        if entry["grid"] != grid:
+            print(f"[DEBUG] Skipping {f}, its grid differs from {valid[0]}")
+            continue
+        valid.append(f)
+    return valid
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""storage.py
+Cache locations and atomic writes, shared by the geometry cache
+(geometry.py), the result cache (results.py), the snapshot index
+(snapshots.py) and the checkpoints (reducer.py).
+
+Every cache lives in a directory of its own, given by an environment
+variable if set, otherwise in $XDG_CACHE_HOME/accretionDiskVisualization/
+(~/.cache by default). Files and directories are written under a temporary
+name next to their target and renamed into place, so readers and
+concurrent writers never see a partial entry and an interrupted write
+leaves the previous version intact.
+
+Typical Usage:
+    import storage
+
+    root = storage.cache_path("results", "ATHENA_RESULT_CACHE")
+    storage.atomic_write(path, lambda f: np.save(f, arr))
+    storage.atomic_write_dir(entry, lambda tmp: save_arrays(tmp))
+"""
+
+# IMPORTS
+import os
+import shutil
+import tempfile
+
+# Directory under $XDG_CACHE_HOME holding every cache
+CACHE_NAME = "accretionDiskVisualization"
+
+
+"""
+Returns the directory of one cache: $env_var if set, otherwise
+$XDG_CACHE_HOME/accretionDiskVisualization/<name> (~/.cache by default).
+Argument(s): name (str), env_var (str)
+Returns: str
+"""
+def cache_path(name, env_var):
+    path = os.environ.get(env_var)
+    if not path:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        path = os.path.join(base, CACHE_NAME, name)
+    return path
+
+
+"""
+Writes a file atomically: writer(f) fills a temporary file in the same
+directory, which then replaces path. The temporary file is removed if
+anything fails, and the exception is passed on.
+Argument(s): path (str), writer (callable taking the open file)
+Optional: mode="wb" ("w" for text)
+Returns: None
+"""
+def atomic_write(path, writer, mode="wb"):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            writer(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return None
+
+
+"""
+Writes a directory atomically: writer(tmp) fills a temporary directory next
+to path, which is then renamed to path. Entries are written once and never
+replaced, so losing the race to another process writing the same entry is
+not an error.
+Argument(s): path (str), writer (callable taking the temporary directory)
+Returns: None
+"""
+def atomic_write_dir(path, writer):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+    try:
+        writer(tmp)
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isdir(path): # not just lost the race to another process
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return None
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""synthetic.py
+Writes synthetic .athdf files with the Athena++ HDF5 layout, for testing and
+benchmarking without real simulation output.
+
+The grid is spherical_polar with a logarithmic radial spacing (x1rat), as
+in the disk runs. By default x1rat is (r max / r min)^(1/nx1), so the cells
+keep the same relative width at any radial resolution. Root MeshBlocks can
+be refined (static mesh refinement) to any level; a refined root block is
+covered by 2^level blocks per dimension.
+Every variable is an analytic field of (r, theta, phi, time),
+    q_v = cos((v+1) phi) sin(theta) / r^(1 + v/10) + (v+1) time / 100
+plus optional Gaussian noise, so results can be checked against each other.
+
+Typical Usage:
+    import synthetic
+
+    synthetic.write("disk.out1.00000.athdf", block_size=(16, 16, 16),
+                    root_blocks=(4, 4, 8), refine={(0, 1, 2): 1})
+    synthetic.write_series("data/", 10)     # disk.out1.00000.athdf ... 00009
+
+    python synthetic.py data/ -n 10 --block 16 16 16 --root-blocks 4 4 8
+"""
+
+# IMPORTS
+import os
+import argparse
+
+# Other Python Modules
+import numpy as np
+import h5py
+
+# Default datasets and the variables they hold, as in the disk runs
+DATASETS = {"prim": ("rho", "press", "vel1", "vel2", "vel3"),
+            "rad": ("Er", "Fr1", "Fr2", "Fr3")}
+
+
+"""
+Computes n+1 faces between xmin and xmax, each cell ratio times wider than
+the previous one (Athena++ x1rat).
+Argument(s): xmin, xmax (float), ratio (float), n (int)
+Returns: 1d array
+"""
+def faces(xmin, xmax, ratio, n):
+    if ratio == 1.0:
+        return np.linspace(xmin, xmax, n + 1)
+    return xmin + (1.0 - ratio ** np.arange(n + 1)) / (1.0 - ratio ** n) * (xmax - xmin)
+
+
+"""
+Computes the volume-weighted cell centers Athena++ writes for spherical_polar
+coordinates.
+Argument(s): 1d face arrays r_f, theta_f, phi_f
+Returns: r, theta, phi centers
+"""
+def centers(r_f, theta_f, phi_f):
+    a, b = r_f[:-1], r_f[1:]
+    r = 0.75 * (b**4 - a**4) / (b**3 - a**3)
+    a, b = theta_f[:-1], theta_f[1:]
+    theta = (np.sin(b) - b*np.cos(b) - np.sin(a) + a*np.cos(a)) / (np.cos(a) - np.cos(b))
+    phi = 0.5 * (phi_f[:-1] + phi_f[1:])
+    return r, theta, phi
+
+
+"""
+Lists the MeshBlocks of the mesh, root blocks in x1-fastest order with each
+refined root block replaced by its children.
+Argument(s): root_blocks (nb1, nb2, nb3), refine (dict of root block (i, j, k): level)
+Returns: list of (level, (l1, l2, l3)) logical locations
+"""
+def mesh_blocks(root_blocks, refine):
+    blocks = []
+    for k in range(root_blocks[2]):
+        for j in range(root_blocks[1]):
+            for i in range(root_blocks[0]):
+                level = refine.get((i, j, k), 0)
+                n = 2 ** level
+                for ck in range(n):
+                    for cj in range(n):
+                        for ci in range(n):
+                            blocks.append((level, (n*i + ci, n*j + cj, n*k + ck)))
+    return blocks
+
+
+"""
+Writes one synthetic .athdf file.
+Argument(s): path (str)
+Optional: block_size=(16, 8, 8) cells per MeshBlock (nx1, nx2, nx3),
+  root_blocks=(4, 2, 2) root MeshBlocks per dimension,
+  refine={} root block (i, j, k) to refinement level,
+  x1=(1.0, 10.0, None) (r min, r max, x1rat; None for (r max / r min)^(1/nx1)), 
+  x2=(0, pi), x3=(0, 2 pi),
+  datasets=DATASETS, time=0.0, cycle=None (default 100 * time),
+  noise=0.0 (standard deviation of the added noise), seed=0, dtype=float32
+Returns: None
+"""
+def write(path, block_size=(16, 8, 8), root_blocks=(4, 2, 2), refine=None,
+          x1=(1.0, 10.0, None), x2=(0.0, np.pi), x3=(0.0, 2*np.pi),
+          datasets=DATASETS, time=0.0, cycle=None, noise=0.0, seed=0, dtype=np.float32):
+    refine = refine or {}
+    rng = np.random.default_rng(seed)
+    root_size = [block_size[d] * root_blocks[d] for d in range(3)]
+    x1 = x1_range(x1)
+    if x1[2] is None: # a fixed ratio collapses the inner float32 faces on fine grids
+        x1 = (x1[0], x1[1], (x1[1] / x1[0]) ** (1.0 / root_size[0]))
+    root_x = [x1, (x2[0], x2[1], 1.0), (x3[0], x3[1], 1.0)]
+    blocks = mesh_blocks(root_blocks, refine)
+    n_blocks = len(blocks)
+    names = [name for variables in datasets.values() for name in variables]
+
+    # Faces and centers of every block
+    xf = [np.empty((n_blocks, block_size[d] + 1)) for d in range(3)]
+    xv = [np.empty((n_blocks, block_size[d])) for d in range(3)]
+    level_faces = {}
+    for b, (level, location) in enumerate(blocks):
+        for d in range(3):
+            if (level, d) not in level_faces:
+                ratio = root_x[d][2] ** (1.0 / 2**level)
+                level_faces[level, d] = faces(root_x[d][0], root_x[d][1], ratio, root_size[d] * 2**level)
+            start = location[d] * block_size[d]
+            xf[d][b] = level_faces[level, d][start:start + block_size[d] + 1]
+        xv[0][b], xv[1][b], xv[2][b] = centers(xf[0][b], xf[1][b], xf[2][b])
+
+    with h5py.File(path, "w") as f:
+        f.attrs["Coordinates"] = np.bytes_("spherical_polar")
+        f.attrs["DatasetNames"] = np.array([np.bytes_(name) for name in datasets])
+        f.attrs["MaxLevel"] = np.int32(max(level for level, _ in blocks))
+        f.attrs["MeshBlockSize"] = np.array(block_size, dtype=np.int32)
+        f.attrs["NumCycles"] = np.int32(int(100 * time) if cycle is None else cycle)
+        f.attrs["NumMeshBlocks"] = np.int32(n_blocks)
+        f.attrs["NumVariables"] = np.array([len(v) for v in datasets.values()], dtype=np.int32)
+        f.attrs["RootGridSize"] = np.array(root_size, dtype=np.int32)
+        for d in range(3):
+            f.attrs[f"RootGridX{d + 1}"] = np.array(root_x[d], dtype=np.float64)
+        f.attrs["Time"] = np.float64(time)
+        f.attrs["VariableNames"] = np.array([np.bytes_(name) for name in names])
+
+        f["Levels"] = np.array([level for level, _ in blocks], dtype=np.int32)
+        f["LogicalLocations"] = np.array([location for _, location in blocks], dtype=np.int64)
+        for d in range(3):
+            f[f"x{d + 1}f"] = xf[d].astype(dtype)
+            f[f"x{d + 1}v"] = xv[d].astype(dtype)
+
+        # Fields, format [variable, block, phi, theta, r]
+        r = xv[0][:, None, None, :]
+        theta = xv[1][:, None, :, None]
+        phi = xv[2][:, :, None, None]
+        v = 0
+        for dataset, variables in datasets.items():
+            out = f.create_dataset(dataset, (len(variables), n_blocks) + tuple(block_size[::-1]), dtype=dtype)
+            for n in range(len(variables)):
+                field = np.cos(phi * (v+1)) * np.sin(theta) / r ** (1 + 0.1*v) + 0.01 * (v+1) * time
+                if noise:
+                    field = field + noise * rng.standard_normal(field.shape)
+                out[n] = field
+                v += 1
+    return None
+
+
+"""
+Writes a series of snapshots <prefix>.NNNNN.athdf with times 0, dt, 2 dt, ...
+Argument(s): directory (str), n (int)
+Optional: prefix="disk.out1", dt=1.0, first=0 (number of the first snapshot),
+  keyword arguments for write
+Returns: list of the paths written
+"""
+def write_series(directory, n, prefix="disk.out1", dt=1.0, first=0, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(first, first + n):
+        path = os.path.join(directory, f"{prefix}.{number:05d}.athdf")
+        write(path, time=number * dt, seed=number, **kwargs)
+        paths.append(path)
+    return paths
+
+
+"""
+Completes a radial extent (r min, r max) or (r min, r max, x1rat) to three
+entries, with None for the default ratio.
+Returns: (float, float, float or None)
+"""
+def x1_range(values):
+    values = tuple(values)
+    if len(values) not in (2, 3):
+        raise ValueError(f"x1 must be (r min, r max) or (r min, r max, x1rat), got {values}.")
+    return values if len(values) == 3 else values + (None,)
+
+
+"""
+Parses a refinement argument "i,j,k[:level]" (level 1 by default).
+"""
+def refine_spec(value):
+    block, _, level = value.partition(":")
+    try:
+        i, j, k = (int(x) for x in block.split(","))
+        return (i, j, k), int(level or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid refinement, use i,j,k[:level].")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic Athena++ .athdf snapshots.")
+    parser.add_argument("directory", help="Directory the snapshots are written to.")
+    parser.add_argument("-n", type=int, default=1, help="Number of snapshots (default: 1).")
+    parser.add_argument("--first", type=int, default=0, help="Number of the first snapshot (default: 0).")
+    parser.add_argument("--prefix", default="disk.out1", help="File name prefix (default: disk.out1).")
+    parser.add_argument("--block", type=int, nargs=3, default=(16, 8, 8), metavar=("NX1", "NX2", "NX3"),
+    help="Cells per MeshBlock (default: 16 8 8).")
+    parser.add_argument("--root-blocks", type=int, nargs=3, default=(4, 2, 2), metavar=("NB1", "NB2", "NB3"),
+    help="Root MeshBlocks per dimension (default: 4 2 2).")
+    parser.add_argument("--refine", type=refine_spec, action="append", default=[],
+    help="Refine root block i,j,k to a level, as i,j,k[:level]. May be repeated.")
+    parser.add_argument("--x1", type=float, nargs="+", default=(1.0, 10.0), metavar="X",
+    help="Radial extent and optionally x1rat, as RMIN RMAX [RATIO] (default: 1 10, ratio (RMAX/RMIN)^(1/NX1)).")
+    parser.add_argument("--variables", nargs="+", metavar="DATASET=VAR,VAR",
+    help="Datasets to write, e.g. rad=Er,Fr1,Fr2,Fr3 (default: prim and rad).")
+    parser.add_argument("--dt", type=float, default=1.0, help="Time between snapshots (default: 1).")
+    parser.add_argument("--noise", type=float, default=0.0, help="Standard deviation of added noise (default: 0).")
+    args = parser.parse_args()
+    if len(args.x1) not in (2, 3):
+        parser.error("--x1 takes RMIN RMAX [RATIO]")
+
+    datasets = DATASETS
+    if args.variables:
+        datasets = {}
+        for spec in args.variables:
+            dataset, _, variables = spec.partition("=")
+            datasets[dataset] = tuple(variables.split(","))
+
+    paths = write_series(args.directory, args.n, prefix=args.prefix, dt=args.dt, first=args.first,
+                         block_size=tuple(args.block), root_blocks=tuple(args.root_blocks),
+                         refine=dict(args.refine), x1=tuple(args.x1), datasets=datasets, noise=args.noise)
+    print(f"Wrote {len(paths)} snapshots to {os.path.abspath(args.directory)}")
+
+if __name__ == "__main__":
+    main()
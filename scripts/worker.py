@@ -11,17 +11,37 @@ import os
 
 # Helper Module
 import athena_read
+import geometry
+import instrument
+import shared
 
 # Other Python Modules
 import numpy as np
 
+# Variables read from each file, the rest of the file is never touched
+QUANTITIES = ("Fr1", "Fr2", "Fr3")
+
+# Estimated peak bytes per cell of a divergence window: the float32 inputs, the
+# float64 sum, the volume element, the stencil temporaries and the masked
+# result. The peak RSS of run_program grows by about 50 per cell, rounded up
+# for headroom. Used to size the phi slabs of chunked_divergence.
+CELL_BYTES = 64
+
+# The same in float32 precision (about 36 measured), see divergence
+CELL_BYTES_FLOAT32 = 48
+
 
 """
 Arguments: 
-String: file_path, int radius
-Returns: None
+String: file_path, int radius or list of int radii
+Optional: output_f="", shell=True (only compute the requested radii), 
+  max_bytes=None (cap the memory of the divergence at about max_bytes by 
+  processing the cube in phi slabs, see chunked_divergence), 
+  float32=False (compute in float32, see divergence)
+Returns: 2d array of format [phi, theta] for one radius, 
+  3d array of format [radius, phi, theta] for a list of radii
 """
-def run_program(file_path, radius, output_f=""):
+def run_program(file_path, radius, output_f="", shell=True, max_bytes=None, float32=False):
     # TODO: rewrite debugging code as error validation to catch errors. error handling
     # Debugging file access issues
     print(f"[INFO] Attempting to open: {file_path}", file=sys.stderr)
@@ -33,7 +53,7 @@ def run_program(file_path, radius, output_f=""):
        print(f"[DEBUG] Volume Mounted? /Volumes/Athena → {os.path.ismount('/Volumes/Athena')}", file=sys.stderr)
        parent_dir = os.path.dirname(file_path)
        print(f"[DEBUG] Files in {parent_dir}:", os.listdir(parent_dir), file=sys.stderr)
-       sys.exit(1)    
+       raise FileNotFoundError(f"No such file: {file_path}")
 
 
     """
@@ -45,79 +65,244 @@ def run_program(file_path, radius, output_f=""):
         sys.exit(1)
     """
     
-    # Read the file and validate data
-    data = athena_read.athdf(file_path)
-    key_validation(data)
+    # Grid geometry, shared with the other workers through the cache
+    geom = geometry.load(file_path)
 
-    # Get relevant quantities
-    Fr1 = data['Fr1']
-    Fr2 = data['Fr2']
-    Fr3 = data['Fr3']
+    # With a memory budget the file is read and processed one phi slab at a time
+    if max_bytes is not None:
+        result = chunked_divergence(file_path, radius, geom, max_bytes, shell, float32)
+    else:
+        # Read the file and validate data. In shell mode only the radial window 
+        # around the requested radius is read.
+        if shell:
+            data, local = athena_read.athdf_x1_shells(file_path, radius, halo=1, x1f=geom['r_f'],
+                                                      quantities=QUANTITIES)
+            i_r = local if np.ndim(radius) else int(local[0]) # shell indices within the window read
+            start = int(np.atleast_1d(radius)[0]) % len(geom['r']) - int(np.atleast_1d(local)[0])
+            geom = geometry.radial_slice(geom, start, start + len(data['x1v']))
+        else:
+            data = athena_read.athdf(file_path, quantities=QUANTITIES)
+            i_r = radius
+        key_validation(data)
 
-    # Get spherical coordinates
-    r = data['x1v']
-    theta = data['x2v']
-    phi = data['x3v']
+        # Get relevant quantities
+        Fr1 = data['Fr1']
+        Fr2 = data['Fr2']
+        Fr3 = data['Fr3']
+
+        # Get spherical coordinates
+        r = data['x1v']
+        theta = data['x2v']
+        phi = data['x3v']
+
+        # ---- Compute Divergence: ---- #
+        with instrument.span("divergence"):
+            if shell:
+                result = shell_divergence(Fr1, Fr2, Fr3, r, theta, phi, i_r, geom, float32)
+            else:
+                result = divergence(Fr1, Fr2, Fr3, r, theta, phi, geom, float32)
+                result = np.moveaxis(result[:, :, i_r], -1, 0) if np.ndim(i_r) else result[:, :, i_r] #split so that there's less to store later.
+    print(f"Processed {file_path} with radius {radius}, PID: {os.getpid()}") 
+
+    # Save array to .npy file
+    if output_f != "":
+        np.save(output_f, result)
+       
+    return result
+       
+
+"""
+Computes the radiative flux divergence of (Fr1, Fr2, Fr3) on the whole grid. 
+Each term is a forward difference taken over the full array at once: the flux 
+product is formed once and differenced between neighboring cells, with the 
+geometry factors combined into 2d arrays broadcast onto the (phi, theta, r) 
+layout of the data.
+Arguments: 
+3d arrays Fr1, Fr2, Fr3 of format [phi, theta, r], 1d arrays r, theta, phi
+Optional: geom=None, cached geometry (see geometry.py) matching the data, 
+  computed from r, theta, phi when not given, 
+  float32=False (see FLOAT32 PRECISION below)
+Returns: 3d array of format [phi, theta, r], zero where the cell volume is zero
+
+FLOAT32 PRECISION: 
+Athena++ writes Fr1-3 as float32, but the coordinates and geometry are float64, 
+so every 3d temporary is promoted to float64. With float32=True the 1d geometry 
+factors are rounded to float32 instead and all 3d arithmetic stays in float32, 
+halving the memory traffic; only the division by the volume is evaluated in 
+float64, from the float64 volume element. Every flux product a, b of a term 
+then carries a few float32 roundings (u = 2^-24 ~ 6e-8), which the difference 
+a - b keeps as an absolute error. Per cell the bound against float64 is 
+    |Div32 - Div64| <= ~12 u * S / d_volume, 
+    S = sum over the three terms of (|a| + |b|) * (the term's two spacings), 
+i.e. about 1e-6 of the flux through the faces of the cell; the relative error 
+of Div itself is larger where the face fluxes nearly cancel. On the synthetic 
+disk snapshots the largest error is 4.3 u * S / d_volume, or 2e-7 to 1.5e-5 
+of the largest |Div|. 
+"""
+def divergence(Fr1, Fr2, Fr3, r, theta, phi, geom=None, float32=False):
+    if geom is None:
+        d_r, d_theta, d_phi, sin_theta = geometry.geometry_factors(r, theta, phi)
+        d_Volume = geometry.volume_element(r, d_r, sin_theta, d_theta, d_phi)
+    else:
+        d_r, d_theta, d_phi = geom['d_r'], geom['d_theta'], geom['d_phi']
+        sin_theta = geom['sin_theta']
+        d_Volume = geometry.volume(geom)
+    if float32:
+        Fr1, Fr2, Fr3, r, d_r, d_theta, d_phi, sin_theta = (np.asarray(x, dtype=np.float32)
+            for x in (Fr1, Fr2, Fr3, r, d_r, d_theta, d_phi, sin_theta))
+
+    # Geometry factors of each term as 2d arrays, broadcast onto [phi, theta, r]
+    r_sin = np.outer(sin_theta, r)                                   # [theta, r]
+    r2_sin = np.outer(sin_theta, r ** 2)                             # [theta, r]
+    d_theta_d_phi = np.outer(d_phi, d_theta)[:, :, np.newaxis]       # [phi, theta]
+    d_phi_d_r = np.outer(d_phi, d_r)[:, np.newaxis, :]               # [phi, r]
+    d_theta_d_r = np.outer(d_theta, d_r)[np.newaxis, :, :]           # [theta, r]
+
+    # Total divergence, accumulated term by term. Each flux product is formed 
+    # once over the cube and differenced between neighboring cells.
+    Div = np.zeros(Fr1.shape, dtype=np.result_type(Fr1, r))
 
-    # Initializing reusable constants
-    len_r = len(r)
-    len_th = len(theta)
-    len_phi = len(phi)
-
-    # Initialze arrays
-    d_r = np.zeros_like(r)
-    d_theta = np.zeros_like(theta)
-    d_phi = np.zeros_like(phi)
-    sin_theta = np.zeros_like(theta) #similar dimensions, only different values.
-
-    # Appropriately adjust these arrays
-    d_r[1:-1] = (r[2:] - r[:-2]) / 2
-    d_theta[1:-1] = (theta[2:] - theta[:-2]) / 2
-    d_phi[1:-1] = (phi[2:] - phi[:-2]) / 2
-    sin_theta[:] = np.sin(theta[:])
-
-    # Initialize arrays
-    Div = np.zeros_like(Fr1) # total divergence
-    t1 = np.zeros_like(Div) #r term
-    t2 = np.zeros_like(Div) # theta term
-    t3 = np.zeros_like(Div) # phi term
-
-    # ---- Compute Divergence: ---- #
     # r term
-    for i in range(1, len_r-1):
-        a = Fr1[:, :, i+1] * (r[i+1] ** 2) * sin_theta[:]  # shape (256, 256)
-        b = Fr1[:, :, i]   * (r[i]   ** 2) * sin_theta[:]
-        t1[:, :, i] = (a - b) * d_theta[:] * d_phi[:]
+    flux = Fr1 * r2_sin
+    term = flux[:, :, 2:] - flux[:, :, 1:-1]
+    term *= d_theta_d_phi
+    Div[:, :, 1:-1] += term
 
     # theta term
-    for j in range(1, len_th - 1):
-        a = Fr2[:, j+1, :] * r[:] * sin_theta[j+1]  # shape (256, 512)
-        b = Fr2[:, j, :]   * r[:] * sin_theta[j]
-        t2[:, j, :] = (a - b) * d_phi[:, np.newaxis] * d_r
+    flux = Fr2 * r_sin
+    term = flux[:, 2:, :] - flux[:, 1:-1, :]
+    term *= d_phi_d_r
+    Div[:, 1:-1, :] += term
 
     # phi term
-    for k in range(1, len_phi - 1):
-        a = Fr3[k+1, :, :] * r[:]  # shape (256, 256)
-        b = Fr3[k, :, :]   * r[:]
-        t3[k, :, :] = (a - b) * d_theta[:, np.newaxis] * d_r
+    flux = Fr3 * r
+    term = flux[2:, :, :] - flux[1:-1, :, :]
+    term *= d_theta_d_r
+    Div[1:-1, :, :] += term
+    del flux, term
 
-    # Total Divergence
-    Div = t1 + t2 + t3
+    # Divide only where the volume is nonzero, avoiding 0/0 on the boundary. 
+    # In float32 the float64 volume is divided out without a float32 copy.
+    result = np.zeros_like(Div)
+    np.divide(Div, d_Volume, out=result, where=(d_Volume != 0))
+    return result
 
-    # Compute Delta Volume
-    d_Volume = (r[np.newaxis, np.newaxis, :] **2 ) * sin_theta[np.newaxis, :, np.newaxis] * d_r[np.newaxis, np.newaxis, :] * d_theta[np.newaxis, :, np.newaxis] * d_phi [:, np.newaxis, np.newaxis]
 
-    result = np.where(d_Volume != 0, Div / d_Volume, 0)
+"""
+Computes the divergence on single radial shells. Only the radial indices 
+radius-1, radius and radius+1 are needed by the stencil, so the full 
+divergence is evaluated on that window and the middle shell is returned. 
+Gives the same values as divergence(...)[:, :, radius].
+Arguments: 
+3d arrays Fr1, Fr2, Fr3 of format [phi, theta, r], 1d arrays r, theta, phi, 
+int radius or list of int radii (negative indices count from the outer boundary)
+Optional: geom=None, cached geometry matching the data, float32=False
+Returns: 2d array of format [phi, theta] for one radius, 
+  3d array of format [radius, phi, theta] for a list of radii
+"""
+def shell_divergence(Fr1, Fr2, Fr3, r, theta, phi, radius, geom=None, float32=False):
+    if np.ndim(radius):
+        return np.stack([shell_divergence(Fr1, Fr2, Fr3, r, theta, phi, rad, geom, float32) for rad in radius])
 
-    result = result[:, :, radius] #split so that there's less to store later.
-    print(f"Processed {file_path} with radius {radius}, PID: {os.getpid()}") 
+    len_r = len(r)
+    if not (-len_r <= radius <= len_r - 1):
+        raise IndexError(f"Radial index {radius} is out of bounds for {len_r} radii.")
+    radius = radius % len_r
 
-    # Save array to .npy file
-    if output_f != "":
-        np.save(output_f, result)
-       
-    return result
-       
+    # Radial window holding the shell and its stencil neighbors
+    lo = max(radius - 1, 0)
+    hi = min(radius + 2, len_r)
+
+    window = divergence(Fr1[:, :, lo:hi], Fr2[:, :, lo:hi], Fr3[:, :, lo:hi],
+                        r[lo:hi], theta, phi,
+                        None if geom is None else geometry.radial_slice(geom, lo, hi), float32)
+    return window[:, :, radius - lo]
+
+
+"""
+Computes the divergence on the requested radii one phi slab at a time, so 
+that only a slab of the cube is in memory at once. Each slab is read with a 
+one-cell halo on both sides for the phi difference, and the rows of the slab 
+are copied into the output. The number of rows per slab is chosen so that 
+the slab takes about max_bytes (estimated with CELL_BYTES, or 
+CELL_BYTES_FLOAT32), at least one row. 
+Gives the same values as the unchunked run_program.
+Arguments: 
+String: file_path, int radius or list of int radii, geom (dict from 
+geometry.load), int max_bytes
+Optional: shell=True (only read the radial window around the requested radii), 
+  float32=False
+Returns: 2d array of format [phi, theta] for one radius, 
+  3d array of format [radius, phi, theta] for a list of radii
+"""
+def chunked_divergence(file_path, radius, geom, max_bytes, shell=True, float32=False):
+    n_phi, n_theta, n_r = geometry.grid_shape(geom)
+    radii = np.atleast_1d(np.asarray(radius, dtype=int))
+    if np.any(radii < -n_r) or np.any(radii >= n_r):
+        raise IndexError(f"Radial index {radius} is out of bounds for {n_r} radii.")
+    radii = radii % n_r
+
+    # Radial window read from the file
+    r_lo, r_hi = radial_window(radii, n_r, shell)
+    geom = geometry.radial_slice(geom, r_lo, r_hi)
+    cell_bytes = CELL_BYTES_FLOAT32 if float32 else CELL_BYTES
+    rows = max(int(max_bytes // (cell_bytes * n_theta * (r_hi - r_lo))) - 2, 1)
+
+    result = None
+    for k0 in range(0, n_phi, rows):
+        k1 = min(k0 + rows, n_phi)
+        lo, hi = max(k0 - 1, 0), min(k1 + 1, n_phi) # slab with its halo
+        data = athena_read.athdf(file_path, quantities=QUANTITIES,
+                                 x1_min=geom['r_f'][0], x1_max=geom['r_f'][-1],
+                                 x3_min=geom['phi_f'][lo], x3_max=geom['phi_f'][hi])
+        key_validation(data)
+        slab = geometry.phi_slice(geom, lo, hi)
+
+        with instrument.span("divergence"):
+            args = (data['Fr1'], data['Fr2'], data['Fr3'], data['x1v'], data['x2v'], data['x3v'])
+            if shell:
+                out = shell_divergence(*args, radii - r_lo, slab, float32)
+            else:
+                out = np.moveaxis(divergence(*args, slab, float32)[:, :, radii], -1, 0)
+            del data, args
+            if result is None:
+                result = np.zeros((len(radii), n_phi, n_theta), dtype=out.dtype)
+            result[:, k0:k1] = out[:, k0 - lo:k1 - lo]
+
+    return result if np.ndim(radius) else result[0]
+
+
+"""
+Returns the radial indices r_lo:r_hi read from a file for the requested 
+radii: the stencil neighbors of the radii in shell mode, every radius otherwise.
+Arguments: radii (list of int, non-negative), n_r (int)
+Optional: shell=True
+Returns: (r_lo, r_hi)
+"""
+def radial_window(radii, n_r, shell=True):
+    if not shell:
+        return 0, n_r
+    return max(int(min(radii)) - 1, 0), min(int(max(radii)) + 2, n_r)
+
+
+"""
+Estimates the peak memory of run_program on one file, for sizing the worker 
+pool (see resources.py). Based on CELL_BYTES, measured on files holding Fr1-3 
+as float32 as Athena++ writes them.
+Arguments: shape (n_phi, n_theta, n_r) of the grid, int radius or list of int radii
+Optional: shell=True, max_bytes=None, float32=False, as in run_program
+Returns: int bytes
+"""
+def task_bytes(shape, radius, shell=True, max_bytes=None, float32=False):
+    n_phi, n_theta, n_r = shape
+    radii = np.atleast_1d(radius) % n_r
+    r_lo, r_hi = radial_window(radii, n_r, shell)
+    row_bytes = (CELL_BYTES_FLOAT32 if float32 else CELL_BYTES) * n_theta * (r_hi - r_lo)
+
+    peak = n_phi * row_bytes
+    if max_bytes is not None: # a slab of at least one row and its halo
+        peak = min(peak, max(max_bytes, 3 * row_bytes))
+    return int(peak + len(radii) * n_phi * n_theta * 8) # plus the float64 result
 
 
 def key_validation(data):
@@ -145,16 +330,28 @@ def key_validation(data):
 
 def main():
     args = sys.argv[1:]
+    max_bytes = None
+    if "--max-bytes" in args: # Memory budget of the divergence, see chunked_divergence
+        i = args.index("--max-bytes")
+        max_bytes = int(args[i + 1])
+        del args[i:i + 2]
+    float32 = "--float32" in args # Compute in float32, see divergence
+    if float32:
+        args.remove("--float32")
     if len(args) < 2: 
-        print("Usage: python worker.py <radius> <file> <optional output_path>", file=sys.stderr)
+        print("Usage: python worker.py <radius[,radius...]> <file> <optional output_path | --shm name index> [--max-bytes N] [--float32]", file=sys.stderr)
         sys.exit(1)
-    radius = int(args[0])
+    radius = [int(rad) for rad in args[0].split(",")] if "," in args[0] else int(args[0])
     file_path = args[1]
-    if len(args) > 2:
-        output_path = sys.argv[3]
-        run_program(file_path, radius, output_path)
+    if len(args) > 3 and args[2] == "--shm": # Hand the result back through shared memory
+        radius = [int(rad) for rad in args[0].split(",")] # the controller's slots hold a map per radius
+        result = run_program(file_path, radius, max_bytes=max_bytes, float32=float32)
+        shared.write_result(args[3], int(args[4]), result, untrack=True)
+    elif len(args) > 2:
+        output_path = args[2]
+        run_program(file_path, radius, output_path, max_bytes=max_bytes, float32=float32)
     else: # No output specified, just do computation
-        run_program(file_path, radius)
+        run_program(file_path, radius, max_bytes=max_bytes, float32=float32)
 
 if __name__ == "__main__":
     main()